@@ -1,61 +1,567 @@
+import argparse
+from collections import deque
+from functools import partial
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from os import path, remove
+from math import ceil, sqrt
 import os
 import re
+import sys
+import tempfile
+import time
 try:
-    from PIL.Image import ANTIALIAS, fromarray, new
-    from PIL import ImageFile, Image
+    # LANCZOS is the filter ANTIALIAS aliased; the alias is gone in Pillow 10
+    from PIL.Image import LANCZOS, new
+    from PIL import Image
 except ModuleNotFoundError:
     print("Could not find PIL")
-from numpy import array, uint8
+from numpy import asarray, ascontiguousarray, clip, divide, int16, power, uint8, where
+try:
+    from . encoders import ENCODERS, encode_to_budget, extension, measure_encoders, prepare, write_png
+except ImportError:
+    # Run as a script rather than as part of the add-on
+    from encoders import ENCODERS, encode_to_budget, extension, measure_encoders, prepare, write_png
+try:
+    from . profiling import Profiler
+    from . frame_archive import FrameArchive, write_archive
+    from . quantize import PALETTE_SAMPLES, sample_pixels
+except ImportError:
+    from profiling import Profiler
+    from frame_archive import FrameArchive, write_archive
+    from quantize import PALETTE_SAMPLES, sample_pixels
+
+
+class FrameStore(object):
+    """
+    A list of cropped frames which keeps at most memory_budget bytes of pixels
+    in memory. Once the budget is exceeded the oldest frames are spilled to a
+    temporary directory as raw pixels and read back one at a time on access.
+    A budget of None keeps every frame in memory. Frames that already live
+    elsewhere, such as in a FrameArchive, are added as loaders and don't count
+    against the budget.
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self.frames = []
+        self.in_memory = 0
+        self.next_spill = 0
+        self.spill_directory = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        frame = self.frames[index]
+        if isinstance(frame, tuple):
+            filename, mode, size = frame
+            with open(filename, 'rb') as f:
+                return Image.frombytes(mode, size, f.read())
+        if callable(frame):
+            return frame()
+        return frame
+
+    def __iter__(self):
+        for i in range(len(self.frames)):
+            yield self[i]
+
+    def append(self, image):
+        self.frames.append(image)
+        self.in_memory += frame_bytes(image)
+        if self.memory_budget is not None:
+            self.spill()
+
+    def append_loader(self, loader):
+        """
+        Adds a frame by a function that returns its image when called.
+        """
+        self.frames.append(loader)
+
+    def spill(self):
+        """
+        Writes in-memory frames to disk, oldest first, until the frames left
+        in memory fit inside the budget.
+        """
+        if self.spill_directory is None:
+            self.spill_directory = tempfile.TemporaryDirectory(
+                prefix='splt_frames_')
+        while self.in_memory > self.memory_budget and self.next_spill < len(self.frames):
+            image = self.frames[self.next_spill]
+            if not isinstance(image, Image.Image):
+                self.next_spill += 1
+                continue
+            filename = os.path.join(
+                self.spill_directory.name, 'frame%d.raw' % self.next_spill)
+            with open(filename, 'wb') as f:
+                f.write(image.tobytes())
+            self.frames[self.next_spill] = (filename, image.mode, image.size)
+            self.in_memory -= frame_bytes(image)
+            self.next_spill += 1
+
+    def close(self):
+        """
+        Removes any spilled frames from disk.
+        """
+        if self.spill_directory is not None:
+            self.spill_directory.cleanup()
+            self.spill_directory = None
+
+
+def frame_bytes(image):
+    """
+    Number of bytes the pixels of a PIL image take up in memory.
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+def crop_frame(image):
+    """
+    Finds the lines bounding the visible pixels of an RGBA image from its alpha
+    band alone, then crops to them, so the crop is the only copy of the frame.
+    Returns the crop box and the cropped image.
+    """
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    bbox = image.getchannel('A').getbbox()
+    if bbox is None:
+        raise ValueError('Frame has no visible pixels')
+    # The right and bottom crop lines are the last visible ones, not one past
+    box = (bbox[0], bbox[1], bbox[2] - 1, bbox[3] - 1)
+    return box, image.crop(box)
+
+
+def measure_frame(file):
+    """
+    Opens and decodes a frame, then crops it, see crop_frame.
+    Returns the crop box, the cropped image and the seconds spent per stage.
+    """
+    start = time.perf_counter()
+    image = Image.open(file)
+    image.load()
+    decoded = time.perf_counter()
+    box, image = crop_frame(image)
+    return box, image, {'decode': decoded - start, 'bbox': time.perf_counter() - decoded}
+
+
+def crop_array(array, linear=False, premultiplied=False):
+    """
+    Crops a (height, width, 4) RGBA array, top row first, to its visible pixels
+    like crop_frame, finding them from the alpha channel alone.
+    Float arrays hold 0-1 values and are converted to 8 bits after cropping, so
+    only the cropped region is converted: linear values are encoded to sRGB and
+    premultiplied colours are divided by their alpha on the way.
+    Returns the crop box and the cropped image.
+    """
+    if array.dtype == uint8:
+        visible = array[..., 3] > 0
+    else:
+        # The lowest alpha that still rounds to a visible 8-bit pixel
+        visible = array[..., 3] >= 0.5 / 255
+    horizontal = visible.any(axis=0).nonzero()[0]
+    vertical = visible.any(axis=1).nonzero()[0]
+    if not len(horizontal):
+        raise ValueError('Frame has no visible pixels')
+    box = (int(horizontal[0]), int(vertical[0]), int(horizontal[-1]), int(vertical[-1]))
+    cropped = array[box[1]:box[3], box[0]:box[2]]
+    if cropped.dtype != uint8:
+        cropped = clip(cropped, 0, 1)
+        if premultiplied:
+            alpha = cropped[..., 3:]
+            cropped[..., :3] = divide(cropped[..., :3], alpha,
+                                      out=cropped[..., :3].copy(), where=alpha > 0)
+            cropped = clip(cropped, 0, 1)
+        if linear:
+            rgb = cropped[..., :3]
+            cropped[..., :3] = where(rgb <= 0.0031308, rgb * 12.92,
+                                     1.055 * power(rgb, 1 / 2.4) - 0.055)
+        cropped = (cropped * 255 + 0.5).astype(uint8)
+    return box, Image.fromarray(ascontiguousarray(cropped))
+
+
+def measure_array(array, linear=False, premultiplied=False):
+    """
+    Crops an in-memory frame, see crop_array.
+    Returns the crop box, the cropped image and the seconds spent per stage.
+    """
+    start = time.perf_counter()
+    box, image = crop_array(array, linear, premultiplied)
+    return box, image, {'bbox': time.perf_counter() - start}
+
+
+def frame_from_buffer(buffer, size):
+    """
+    Wraps a raw RGBA buffer, such as bytes, a memoryview or a contiguous uint8
+    array, in a PIL image without copying it.
+    """
+    return Image.frombuffer('RGBA', size, buffer, 'raw', 'RGBA', 0, 1)
+
+
+def resize_frame(image, size):
+    """
+    Resamples a cropped frame to its size on the sheet.
+    """
+    return image.resize(size, LANCZOS)
+
+
+def ordered_map(pool, function, args, window):
+    """
+    Calls function on each tuple of args on the pool and yields the results in
+    order. Only window calls are in flight at once, so lazy args such as a
+    FrameStore spilled to disk are not all read into memory.
+    """
+    pending = deque()
+    for arg in args:
+        pending.append(pool.submit(function, *arg))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def keep_frames(frames, store):
+    """
+    Yields frames, appending each to store on the way past.
+    """
+    for frame in frames:
+        store.append(frame)
+        yield frame
+
+
+def strip_layout(sizes, crops, max_frame_size):
+    """
+    Lays the frames out left to right in a single row with a 1px gap.
+    Each frame gets an offset map entry of its offset, height and left crop.
+    Frame widths aren't in the map but taken from the next frame's offset, so
+    frames can't share slots here, see atlas_layout.
+    Returns the frame positions, offset map, sheet size and extra description.
+    """
+    positions = []
+    offset_map = []
+    curr_offset = 0
+    for i, (size, crop) in enumerate(zip(sizes, crops)):
+        positions.append((curr_offset, crop[1]))
+        # Offset map adds 1 manually for some reason
+        offset_map += [curr_offset-i, size[1], crop[0]]
+        # Increase by 1 each time to add a 1px gap
+        curr_offset += size[0]+1
+    return positions, offset_map, (curr_offset, max_frame_size[1]), ''
+
+
+def atlas_layout(sizes, crops, max_frame_size, slots=None):
+    """
+    Lays the frames out in a near-square grid of cells one max frame plus a
+    1px gap in size, so large sheets stay within common texture limits.
+    Each frame gets an offset map entry of its x, y, width, height and left crop.
+    slots maps each frame to the frame whose slot it shares, see find_duplicates.
+    Returns the frame positions, offset map, sheet size and extra description.
+    """
+    cell = (max_frame_size[0]+1, max_frame_size[1]+1)
+    cells = len(sizes) if not slots else sum(1 for i, slot in enumerate(slots) if slot == i)
+    columns = max(1, int(ceil(sqrt(cells * cell[1] / cell[0]))))
+    rows = int(ceil(cells / columns))
+    positions = []
+    corners = []
+    offset_map = []
+    used = 0
+    for i, (size, crop) in enumerate(zip(sizes, crops)):
+        slot = slots[i] if slots else i
+        if slot != i:
+            x, y = corners[slot]
+            positions.append(positions[slot])
+        else:
+            x = (used % columns) * cell[0]
+            y = (used // columns) * cell[1]
+            positions.append((x, y + crop[1]))
+            used += 1
+        corners.append((x, y))
+        offset_map += [x, y, size[0], size[1], crop[0]]
+    description = '\n  | layout = atlas\n  | columns = %d\n  | sheetheight = %d' % (
+        columns, rows * cell[1])
+    return positions, offset_map, (columns * cell[0], rows * cell[1]), description
+
+
+def find_duplicates(frames, crops, tolerance=0):
+    """
+    Maps each scaled frame to the first frame it repeats, pixel for pixel when
+    tolerance is 0, otherwise when no channel of any pixel differs by more than
+    tolerance. Frames only match at the same size and top crop, since they have
+    to fit the same slot on the sheet.
+    Returns a list holding, for each frame, the index of the frame whose slot it
+    uses, which is its own index for a unique frame.
+    """
+    slots = []
+    exact = {}
+    similar = {}
+    for i, (frame, crop) in enumerate(zip(frames, crops)):
+        key = (frame.size, crop[1])
+        digest = (key, hashlib.blake2b(frame.tobytes(), digest_size=16).digest())
+        slot = exact.get(digest)
+        if slot is None and tolerance:
+            pixels = asarray(frame, dtype=int16)
+            for j, other in similar.get(key, []):
+                if abs(pixels - other).max() <= tolerance:
+                    slot = j
+                    break
+            else:
+                similar.setdefault(key, []).append((i, pixels))
+        if slot is None:
+            slot = i
+            exact[digest] = i
+        slots.append(slot)
+    return slots
+
+
+def iter_bands(frames, positions, sheet_size, band_height=64):
+    """
+    Composes the sheet band_height rows at a time from scaled frames given in
+    the order of their positions. Frames are pulled from the iterator only once
+    a band needs them and dropped after their last row, so with an atlas only
+    about a row of cells is held at once.
+    Yields the top row and image of each band.
+    """
+    frames = iter(frames)
+    live = []
+    pulled = 0
+    for top in range(0, sheet_size[1], band_height):
+        bottom = min(top + band_height, sheet_size[1])
+        needed = [i for i, position in enumerate(positions) if position[1] < bottom]
+        while needed and pulled <= needed[-1]:
+            live.append((next(frames), positions[pulled]))
+            pulled += 1
+        band = new(mode='RGBA', color=(255, 255, 255, 0),
+                   size=(sheet_size[0], bottom - top))
+        for image, (x, y) in live:
+            if y + image.height > top:
+                band.paste(image, (x, y - top), image)
+        live = [(image, position) for image, position in live
+                if position[1] + image.height > bottom]
+        yield top, band
+
+
+def worker_pool(workers=None):
+    """
+    Returns an executor for frame work. Inside Blender, where this module is
+    part of the add-on package, this is a thread pool: forking the Blender
+    process isn't safe, and a freshly spawned interpreter can't import the
+    add-on. Pillow's decoders mostly run without holding the GIL anyway.
+    The command line and benchmark get a process pool.
+    """
+    if __package__:
+        return ThreadPoolExecutor(workers)
+    return ProcessPoolExecutor(workers)
 
 
 class ImageProcessor(object):
     """
     A class to handle all the imageprocessing done on the screenshots.
     Deals with blending (finding transparency), cropping, and stitching.
+    memory_budget caps the bytes of cropped frames held in memory, see FrameStore.
+    Stage timings go to profiler, which is written out next to the offsets.
     """
 
-    def __init__(self, y_rotations, x_rotations):
+    def __init__(self, y_rotations, x_rotations, memory_budget=None, profiler=None):
         self.target_dimension = 280
         self.target_size = 512 * 1024  # 512 KB
         self.cropping = {'left': [], 'top': [], 'right': [], 'bottom': []}
-        self.images = []
+        self.images = FrameStore(memory_budget)
         self.y_rotations = y_rotations
         self.x_rotations = 2*x_rotations+1  # Total vertical rotations
+        self.profiler = profiler or Profiler()
+        # Frames given by step and tilt that arrived ahead of earlier ones
+        self.pending = {}
+        self.pipeline = None
+        self.archive = None
+        # A FrameCache, and the keys of frames to store in it once they arrive
+        self.cache = None
+        self.cache_keys = {}
 
     def blend(self, file):
         """
-        Blends the two images into an alpha image using percieved luminescence.
-        https://en.wikipedia.org/wiki/Luma_(video)#Use_of_relative_luminance
-        Then, finds the closest-cropped lines that are all white.
-        Uses numpy because traversing python arrays is very slow.
+        Finds the closest-cropped lines around the visible pixels of a frame
+        using its alpha band, then stores the cropped frame.
         """
         print(file)
-        blended_arr = Image.open(file)
-        blended_arr = array(blended_arr)
-        # Calculate crop lines
-        horizontal = blended_arr[:, :, 3].any(axis=0).nonzero()[0]
-        vertical = blended_arr[:, :, 3].any(axis=1).nonzero()[0]
-        self.cropping['left'].append(horizontal[0])
-        self.cropping['top'].append(vertical[0])
-        self.cropping['right'].append(horizontal[-1])
-        self.cropping['bottom'].append(vertical[-1])
-        # This needs to be a uint8 to render correctly.
-        blended_image = fromarray(blended_arr.astype(uint8), mode='RGBA')
-        blended_image = blended_image.crop((
-            horizontal[0],
-            vertical[0],
-            horizontal[-1],
-            vertical[-1]
-        ))
-        self.images.append(blended_image)
-
-    def stitch_and_upload(self, directory, file_format="PNG"):
-        """
-        Crops the images to a shared size, then pastes them together.
+        self.add_cropped(*measure_frame(file))
+
+    def blend_buffer(self, buffer, size):
+        """
+        Blends a frame given as a raw RGBA buffer of the given (width, height).
+        Only the cropped region is copied out of the buffer.
+        """
+        with self.profiler.stage('bbox'):
+            box, image = crop_frame(frame_from_buffer(buffer, size))
+        self.add_cropped(box, image)
+
+    def add_frame(self, array, step, tilt, linear=False, premultiplied=False):
+        """
+        Blends a frame handed over in memory as a (height, width, 4) RGBA array,
+        top row first, such as pixels read straight from a render, see crop_array.
+        step and tilt place the frame on the sheet, so frames can arrive out of
+        order: they are held back until the frames before them have been added.
+        """
+        self.add_placed(step, tilt, *measure_array(array, linear, premultiplied))
+
+    def add_placed(self, step, tilt, box, image, timings=None):
+        """
+        Adds a cropped frame at its step and tilt, holding it back until the
+        frames before it have been added. It goes into the cache straight
+        away, so a job stopped before then still keeps it.
+        """
+        index = step * self.x_rotations + tilt
+        if index < len(self.images) or index in self.pending:
+            raise ValueError('Frame for step %d, tilt %d was already added' % (step, tilt))
+        if index in self.cache_keys:
+            with self.profiler.stage('cache'):
+                self.cache.put(self.cache_keys.pop(index), box, image)
+        self.pending[index] = (box, image, timings)
+        while len(self.images) in self.pending:
+            box, image, timings = self.pending.pop(len(self.images))
+            self.add_cropped(box, image, timings)
+
+    def add_from_cache(self, step, tilt, key):
+        """
+        Adds the frame at step and tilt from cache if it holds key, returning
+        True. Otherwise returns False and the frame is stored under key once it
+        is added, so the caller should render it.
+        """
+        if key in self.cache:
+            self.add_placed(step, tilt, self.cache.box(key), partial(self.cache.load, key))
+            return True
+        self.cache_keys[step * self.x_rotations + tilt] = key
+        return False
+
+    def start_pipeline(self, workers=1):
+        """
+        Starts blending submitted frames in the background on worker_pool, so
+        the cropping of one frame overlaps the rendering of the next.
+        Finished frames are collected on every submit and the remaining ones
+        when the pipeline is finished, which stitch_and_upload does itself.
+        """
+        self.pipeline = worker_pool(workers)
+        self.submitted = deque()
+
+    def submit_frame(self, array, step, tilt, linear=False, premultiplied=False):
+        """
+        Blends an in-memory frame in the background, see add_frame.
+        """
+        self.submit(step, tilt, measure_array, array, linear, premultiplied)
+
+    def submit_file(self, file, step, tilt):
+        """
+        Blends a frame file in the background, see blend.
+        """
+        self.submit(step, tilt, measure_frame, file)
+
+    def submit(self, step, tilt, function, *args):
+        """
+        Runs a measure function in the background for the frame at step and tilt.
+        """
+        self.submitted.append((step, tilt, self.pipeline.submit(function, *args)))
+        self.collect()
+
+    def collect(self, wait=False):
+        """
+        Adds the submitted frames that have finished, in order of submission.
+        With wait every submitted frame is waited for.
+        """
+        while self.submitted and (wait or self.submitted[0][2].done()):
+            step, tilt, future = self.submitted.popleft()
+            self.add_placed(step, tilt, *future.result())
+
+    def finish_pipeline(self):
+        """
+        Waits for every submitted frame and stops the background workers.
+        """
+        if self.pipeline is not None:
+            self.collect(wait=True)
+            self.pipeline.shutdown()
+            self.pipeline = None
+
+    def blend_many(self, files, workers=None, keys=None):
+        """
+        Blends a list of files on a pool of workers, see worker_pool.
+        Frames are decoded and measured concurrently but added in the order
+        given, or placed by the (step, tilt) in keys for each file.
+        """
+        with worker_pool(workers) as pool:
+            for i, measured in enumerate(pool.map(measure_frame, files)):
+                print(files[i])
+                if keys is None:
+                    self.add_cropped(*measured)
+                else:
+                    self.add_placed(*keys[i], *measured)
+
+    def add_cropped(self, box, image, timings=None):
+        """
+        Records the crop box of a frame and stores its cropped image, or a function
+        loading it, along with any stage timings measured for it.
+        """
+        for stage, seconds in (timings or {}).items():
+            self.profiler.record(stage, seconds)
+        self.cropping['left'].append(box[0])
+        self.cropping['top'].append(box[1])
+        self.cropping['right'].append(box[2])
+        self.cropping['bottom'].append(box[3])
+        if callable(image):
+            self.images.append_loader(image)
+        else:
+            self.images.append(image)
+
+    @classmethod
+    def from_archive(cls, filename, memory_budget=None, profiler=None):
+        """
+        Makes an ImageProcessor from a frame archive written by save_archive,
+        ready to stitch again at any target dimension, layout or format.
+        The archive is memory-mapped and its frames are read as they are used.
+        """
+        archive = FrameArchive(filename)
+        p = cls(archive.y_rotations, (archive.x_rotations - 1) // 2, memory_budget, profiler)
+        p.archive = archive
+        for i in range(len(archive)):
+            p.add_cropped(archive.box(i), partial(archive.frame, i))
+        return p
+
+    def save_archive(self, filename):
+        """
+        Writes the cropped frames and their crop boxes into a single frame
+        archive, see write_archive.
+        """
+        self.finish_pipeline()
+        boxes = zip(self.cropping['left'], self.cropping['top'],
+                    self.cropping['right'], self.cropping['bottom'])
+        with self.profiler.stage('write'):
+            write_archive(filename, self.images, boxes, self.y_rotations, self.x_rotations)
+
+    def stitch_and_upload(self, directory, file_format="PNG", layout="STRIP", workers=None,
+                          streaming=False, deduplicate=None, compare_formats=False, dimensions=()):
+        """
+        Crops the images to a shared size, then pastes them together,
+        either in a single row ("STRIP") or a near-square grid ("ATLAS").
+        Frames are resampled on a pool of worker threads, Pillow releases the
+        GIL while resampling.
+        The sheet is encoded with the best options that fit target_size bytes,
+        see encode_to_budget. A target_size of None encodes once with the
+        format's first candidate, without searching.
+        With streaming the full RGBA sheet is never built: a PNG is written
+        strip by strip as its rows are composed, see iter_bands and write_png.
+        deduplicate, if not None, is the tolerance within which repeated frames
+        share a single slot on the sheet, see find_duplicates. Only the ATLAS
+        layout gives each frame its width, so only it can share slots.
+        Formats are written through the encoders registry. With compare_formats
+        the sheet is also encoded with every other format and their sizes and
+        times are added to the profile, see measure_encoders.
+        dimensions lists more target dimensions to write sheets for, named
+        with the dimension after an underscore. The sheet at target_dimension
+        and any larger ones are resampled from the cropped frames, each
+        smaller one from the frames of the next larger one, which are kept
+        within memory_budget the same way as the cropped frames.
+        Frames spilled to disk are removed once the sheets are written, so
+        save_archive must come first and a processor only stitches once.
         Prompts for login and uploads to the wiki when done.
         """
+        self.finish_pipeline()
         # Determining crop bounds
         min_cropping = (
             min(self.cropping['left']),
@@ -69,87 +575,315 @@ class ImageProcessor(object):
             min_cropping[3] - min_cropping[1]
         )
         print('Max frame size: ' + str(max_frame_size))
-        target_ratio = self.target_dimension / max(max_frame_size)
+        larger = sorted(set(d for d in dimensions if d > self.target_dimension))
+        # Largest first, so each level is resampled from the one before it
+        smaller = sorted(set(d for d in dimensions if d < self.target_dimension), reverse=True)
+        frames = self.images
+        try:
+            # Upscaled frames would only blur the levels below them
+            for dimension in larger:
+                self.stitch_level(
+                    directory, self.images, dimension, '_%d' % dimension, min_cropping,
+                    max_frame_size, file_format, layout, workers, streaming, deduplicate,
+                    False, keep=False)
+            for i, dimension in enumerate([self.target_dimension] + smaller):
+                suffix = '_%d' % dimension if i else ''
+                resized = self.stitch_level(
+                    directory, frames, dimension, suffix, min_cropping, max_frame_size,
+                    file_format, layout, workers, streaming, deduplicate,
+                    compare_formats and not suffix, keep=i < len(smaller))
+                if frames is not self.images:
+                    frames.close()
+                frames = resized
+        finally:
+            if frames is not None and frames is not self.images:
+                frames.close()
+            self.images.close()
+        self.profiler.write(directory)
+
+    def stitch_level(self, directory, frames, dimension, suffix, min_cropping, max_frame_size,
+                     file_format, layout, workers, streaming, deduplicate, compare_formats, keep):
+        """
+        Resamples frames, either the cropped frames or those of the level
+        above, so the largest frame's longest side is dimension, and writes
+        their sheet and offsets as weapon<suffix> and weaponoffsets<suffix>.txt.
+        See stitch_and_upload. With keep the resampled frames are returned in
+        a FrameStore with the cropped frames' memory_budget, for the next
+        level to be resampled from.
+        """
+        target_ratio = dimension / max(max_frame_size)
         # target_ratio = 1
         print('Target scaling ratio: %f' % target_ratio)
+        info = self.profiler.info
+        if suffix:
+            info = info.setdefault('levels', {}).setdefault(str(dimension), {})
         max_frame_size = (
             int(target_ratio * max_frame_size[0]),
             int(target_ratio * max_frame_size[1])
         )
         print('Scaled max frame size: ' + str(max_frame_size))
 
-        # Pasting together
-        full_image = new(mode='RGBA', color=(255, 255, 255, 0), size=((
-            (max_frame_size[0]+1)*self.y_rotations*self.x_rotations,
-            max_frame_size[1]
-        )))
-        curr_offset = 0
-        offset_map = []
-        for i, image in enumerate(self.images):
-            image = image.resize((
-                int(image.width*target_ratio),
-                int(image.height*target_ratio),
-            ), ANTIALIAS)
-            left_crop = int(
-                target_ratio*(self.cropping['left'][i]-min_cropping[0]))
-            top_crop = int(
-                target_ratio*(self.cropping['top'][i]-min_cropping[1]))
-            full_image.paste(image, (curr_offset, top_crop), image)
-            # Offset map adds 1 manually for some reason
-            offset_map += [curr_offset-i, image.height, left_crop]
-            # Increase by 1 each time to add a 1px gap
-            curr_offset += image.width+1
-        full_image = full_image.crop((
-            0,
-            0,
-            curr_offset,
-            max_frame_size[1],
-        ))
-        output_file = 'weapon.' + file_format.lower()
+        # The layout only depends on the cropped frame sizes, so unless
+        # duplicates are removed it is known before any frame is resampled
+        sizes = []
+        crops = []
+        for i in range(len(self.images)):
+            sizes.append((
+                int((self.cropping['right'][i]-self.cropping['left'][i])*target_ratio),
+                int((self.cropping['bottom'][i]-self.cropping['top'][i])*target_ratio),
+            ))
+            crops.append((
+                int(target_ratio*(self.cropping['left'][i]-min_cropping[0])),
+                int(target_ratio*(self.cropping['top'][i]-min_cropping[1]))
+            ))
+
+        output_file = 'weapon%s.%s' % (suffix, extension(file_format))
         output_file = os.path.join(directory, output_file)
         if path.exists(output_file):
             remove(output_file)
 
-        # Ensure there is enough allocated space to save the image as progressive
-        ImageFile.MAXBLOCK = full_image.height * full_image.width * 16
+        # Pasting together while the following frames resample on the pool
+        full_image = None
+        kept = None
+        workers = workers or os.cpu_count()
+        with ThreadPoolExecutor(workers) as pool:
+            resized = ordered_map(pool, self.profiler.wrap('resize', resize_frame), zip(
+                frames, sizes), 2 * workers)
+            if keep:
+                # Held for the next level to be resampled from
+                kept = FrameStore(self.images.memory_budget)
+                resized = keep_frames(resized, kept)
+            slots = None
+            if deduplicate is not None and layout != "ATLAS":
+                print("Only the atlas layout can share slots, keeping duplicate frames")
+            elif deduplicate is not None:
+                # Duplicates are only known once every frame is resampled, so
+                # the unique frames are held until the layout is worked out
+                resized = list(resized)
+                with self.profiler.stage('dedup'):
+                    slots = find_duplicates(resized, crops, deduplicate)
+                resized = [image for i, image in enumerate(resized) if slots[i] == i]
+                print('Duplicate frames: %d' % (len(slots) - len(resized)))
 
-        if file_format == "JPEG":
-            full_image = full_image.convert("RGB")
-        full_image.save(output_file, format=file_format)
+            if layout == "ATLAS":
+                positions, offset_map, sheet_size, layout_description = atlas_layout(
+                    sizes, crops, max_frame_size, slots)
+            else:
+                positions, offset_map, sheet_size, layout_description = strip_layout(
+                    sizes, crops, max_frame_size)
+            if slots is not None:
+                positions = [position for i, position in enumerate(positions) if slots[i] == i]
+            print('Sheet size: ' + str(sheet_size))
+            encoder = ENCODERS[file_format]
+            # Only PNG is written in strips and formats without alpha fill an
+            # RGB sheet, the others need the whole RGBA sheet, as does comparing
+            if streaming and (compare_formats or (encoder.alpha and file_format != "PNG")):
+                print("Can't stream this sheet, building it in memory")
+                streaming = False
+            info.update({
+                'frames': len(self.images),
+                'unique_frames': len(positions),
+                'format': file_format,
+                'layout': layout,
+                'streaming': streaming,
+                'target_dimension': dimension,
+                'sheet_size': list(sheet_size),
+            })
+
+            if streaming:
+                bands = self.profiler.iterate('paste', iter_bands(
+                    resized, positions, sheet_size))
+            if streaming and file_format == "PNG":
+                # Composing, encoding and writing are interleaved, so this
+                # encode stage includes the paste and write time
+                with self.profiler.stage('encode'), open(output_file, 'wb') as f:
+                    write_png(f, sheet_size, bands)
+                print('Streamed %d bytes' % path.getsize(output_file))
+            elif streaming:
+                # JPEG can't be written in strips, but the RGB sheet can be
+                # filled directly instead of converting a full RGBA one
+                full_image = new(mode='RGB', size=sheet_size)
+                for top, band in bands:
+                    full_image.paste(band.convert("RGB"), (0, top))
+            else:
+                full_image = new(mode='RGBA', color=(255, 255, 255, 0), size=sheet_size)
+                # Palette formats share one palette between every frame,
+                # fitted to pixels sampled from each of them as they are pasted.
+                # Pasting blends soft edges with the sheet's background, so the
+                # samples are taken from the sheet rather than the frame
+                samples = []
+                for image, position in zip(resized, positions):
+                    with self.profiler.stage('paste'):
+                        full_image.paste(image, position, image)
+                    if encoder.palette or compare_formats:
+                        pasted = full_image.crop((position[0], position[1],
+                                                  position[0] + image.width,
+                                                  position[1] + image.height))
+                        samples.append(sample_pixels(
+                            pasted, PALETTE_SAMPLES // len(positions), len(samples)))
+                if compare_formats:
+                    with self.profiler.stage('compare'):
+                        self.profiler.info['encoders'] = measure_encoders(
+                            full_image, self.target_size, workers, samples=samples)
+                    for result in self.profiler.info['encoders']:
+                        print('%-14s %9d bytes %8.3fs' % (
+                            result['format'], result['bytes'], result['seconds']))
+                if encoder.palette:
+                    with self.profiler.stage('quantize'):
+                        full_image = prepare(full_image, file_format, samples)
+
+        if full_image is not None:
+            with self.profiler.stage('encode'):
+                full_image = prepare(full_image, file_format)
+                data, options = encode_to_budget(
+                    full_image, file_format, self.target_size, workers)
+            print('Encoded %d bytes with %s' % (len(data), options))
+            info.update({'bytes': len(data), 'options': options})
+            with self.profiler.stage('write'), open(output_file, 'wb') as f:
+                f.write(data)
 
         description = '''{{#switch: {{{1|}}}
   | url = <nowiki>%s?%s</nowiki>
   | map = \n%d, %d, %d, %d, %s
-  | height = %d
+  | height = %d%s
   | startframe = 16
   }}<noinclude>{{3D viewer}}[[Category:3D model images]]''' % (
             "url",
             datetime.strftime(datetime.utcnow(), '%Y%m%d%H%M%S'),
-            curr_offset,
+            sheet_size[0],
             max_frame_size[0],
             max_frame_size[1],
             self.x_rotations,
             ', '.join([str(o) for o in offset_map]),
-            self.target_dimension
+            dimension,
+            layout_description
         )
-        with open(os.path.join(directory, "weaponoffsets.txt"), "w+") as f:
+        offsets_file = os.path.join(directory, "weaponoffsets%s.txt" % suffix)
+        with self.profiler.stage('write'), open(offsets_file, "w+") as f:
             f.write(description)
+        return kept
 
 
-if __name__ == "__main__":
+# The frame archive RenderWiki saves next to the sheet
+FRAME_ARCHIVE = 'frames.spltarc'
 
-    directory = os.path.join(os.path.dirname(__file__), 'Booth')
-    files = os.listdir(directory)
-    files.sort(key=lambda f: int(re.sub('\D', '', f)))
-    WIDTH = 197
-    HEIGHT = 152
-    NUM = len(files)
-    Y_ROTATIONS = int(NUM/3)
-    X_ROTATIONS = 3
-    print(Y_ROTATIONS, X_ROTATIONS)
-
-    p = ImageProcessor(Y_ROTATIONS, 1)
-    for i, filename in enumerate(files):
-        print(filename)
-        p.blend(os.path.join(directory, filename))
-    p.stitch_and_upload()
+
+def frame_files(directory):
+    """
+    The rendered frames in directory, ordered by the step and tilt digits that
+    RenderWiki writes into their names.
+    """
+    files = [f for f in os.listdir(directory)
+             if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    files.sort(key=lambda f: int(re.sub(r'\D', '', f)))
+    return [os.path.join(directory, f) for f in files]
+
+
+def process_directory(directory, output=None, rotations=None, tilts=1, file_format="PNG",
+                      layout="STRIP", target_dimension=280, streaming=False, memory_budget=None,
+                      deduplicate=None, compare_formats=False, dimensions=()):
+    """
+    Stitches the frames of one weapon into a sheet and offsets file.
+    directory is either a frame archive, a RenderWiki output folder holding a
+    frame archive or a tmp folder of frames, or a folder of frames. The sheet
+    is written to output, which defaults to the folder holding the frames.
+    rotations defaults to the number of frames over the frames per step, an
+    archive records its own rotations and tilts.
+    Returns the folder the sheet was written to.
+    """
+    archive = None
+    if path.isfile(directory):
+        archive = directory
+        directory = path.dirname(directory)
+    elif path.isfile(os.path.join(directory, FRAME_ARCHIVE)):
+        archive = os.path.join(directory, FRAME_ARCHIVE)
+    output = output or directory
+    if not path.exists(output):
+        os.makedirs(output)
+
+    if archive:
+        p = ImageProcessor.from_archive(archive, memory_budget)
+    else:
+        frames = directory
+        if path.isdir(os.path.join(directory, 'tmp')):
+            frames = os.path.join(directory, 'tmp')
+        files = frame_files(frames)
+        if not files:
+            raise ValueError('No frames found in ' + frames)
+        p = ImageProcessor(rotations or len(files) // (2*tilts+1), tilts, memory_budget)
+        for file in files:
+            p.blend(file)
+    p.target_dimension = target_dimension
+    try:
+        # Directories already run in parallel, so one thread each
+        p.stitch_and_upload(output, file_format, layout, workers=1, streaming=streaming,
+                            deduplicate=deduplicate, compare_formats=compare_formats,
+                            dimensions=dimensions)
+    finally:
+        if p.archive is not None:
+            p.archive.close()
+    return output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Stitches previously rendered weapon frames into wiki sheets, without Blender.')
+    parser.add_argument('directories', nargs='+',
+                        help='RenderWiki output folders, frame archives, or folders of frames')
+    parser.add_argument('--output',
+                        help='write each sheet to a subfolder of this folder, named after its '
+                             'input folder, or archive file unless it is ' + FRAME_ARCHIVE)
+    parser.add_argument('--rotations', type=int,
+                        help='rotation steps, by default worked out from the frame count')
+    parser.add_argument('--tilts', type=int, default=1,
+                        help='tilts either side of level per step (default 1)')
+    parser.add_argument('--format', default="PNG", choices=sorted(ENCODERS))
+    parser.add_argument('--layout', default="STRIP", choices=("STRIP", "ATLAS"))
+    parser.add_argument('--target-dimension', type=int, default=280,
+                        help='size of the largest side of a frame on the sheet (default 280)')
+    parser.add_argument('--dimensions', type=int, nargs='+', default=(),
+                        help='more target dimensions to write sheets for, such as thumbnails, '
+                             'each the size of the largest side of a frame like --target-dimension')
+    parser.add_argument('--streaming', action='store_true',
+                        help='write sheets strip by strip, see stitch_and_upload')
+    parser.add_argument('--dedup', type=int, nargs='?', const=0, metavar='TOLERANCE',
+                        help='store repeated frames once, optionally within a per-channel '
+                             'tolerance, atlas layout only')
+    parser.add_argument('--compare-formats', action='store_true',
+                        help='also encode every sheet with every format and report sizes and times')
+    parser.add_argument('--memory-budget', type=int,
+                        help='MB of cropped frames each weapon keeps in memory')
+    parser.add_argument('--workers', type=int,
+                        help='weapons processed at once (default one per core)')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    with worker_pool(args.workers) as pool:
+        jobs = {}
+        for directory in args.directories:
+            output = None
+            if args.output:
+                name = path.basename(path.normpath(directory))
+                if path.isfile(directory) and name != FRAME_ARCHIVE:
+                    # Archives sharing a folder each get their own output
+                    name = path.splitext(name)[0]
+                elif name == 'tmp' or path.isfile(directory):
+                    name = path.basename(path.dirname(path.normpath(directory)))
+                output = os.path.join(args.output, name)
+            jobs[pool.submit(
+                process_directory, directory, output, args.rotations, args.tilts,
+                args.format, args.layout, args.target_dimension, args.streaming,
+                args.memory_budget and args.memory_budget * 1024 * 1024,
+                args.dedup, args.compare_formats, args.dimensions)] = directory
+        for job in as_completed(jobs):
+            try:
+                print('Wrote ' + job.result())
+            except Exception as e:
+                print('Failed %s: %s' % (jobs[job], e))
+                failed += 1
+    print('%d of %d weapons stitched' % (len(jobs) - failed, len(jobs)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,7 @@
 import bpy
+import importlib.util
+import json
+import os
 import subprocess
 import sys
 from collections import namedtuple
@@ -9,8 +12,10 @@ from bpy.props import (
     IntProperty
 )
 
-from . splt_panel import SPLT_PT_Panel, SPLT_PT_warning_panel
-from . splt_ops import *
+from . profiling import startup
+with startup.stage('import'):
+    from . splt_panel import SPLT_PT_Panel, SPLT_PT_warning_panel
+    from . splt_ops import *
 from bpy.app.handlers import persistent
 
 # This program is free software; you can redistribute it and/or modify
@@ -45,6 +50,9 @@ Dependency = namedtuple("Dependency", ["module", "package", "name"])
 dependencies = (Dependency(module="PIL", package="Pillow", name=None),
                 Dependency(module="numpy", package=None, name=None))
 
+# Where the dependencies were last found, see check_dependencies
+DEPENDENCY_CACHE = "splt_dependencies.json"
+
 
 def install_pip():
     """
@@ -57,18 +65,48 @@ def install_pip():
     :return:
     """
 
-    try:
-        # Check if pip is already installed
-        subprocess.run([sys.executable, "-m",
-                       "pip", "--version"], check=True)
-    except subprocess.CalledProcessError:
-        import os
+    # Check if pip is already installed, without starting another Python
+    if importlib.util.find_spec("pip") is None:
         import ensurepip
 
         ensurepip.bootstrap()
         os.environ.pop("PIP_REQ_TRACKER", None)
 
 
+def check_dependencies():
+    """
+    Whether every dependency can be imported, looked up with find_spec so none
+    of them is actually imported. The files they were found in are cached for
+    the next session, and trusted while this Python is the same and the files
+    are still there. Missing dependencies aren't cached, so installing them
+    is noticed.
+    """
+    cache_file = os.path.join(bpy.utils.user_resource('CONFIG'), DEPENDENCY_CACHE)
+    python = [sys.executable, sys.version]
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["python"] == python and all(os.path.exists(origin) for origin in cached["origins"]):
+            return True
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    origins = []
+    for dependency in dependencies:
+        spec = importlib.util.find_spec(dependency.module)
+        if spec is None or spec.origin is None:
+            print("Could not find " + dependency.module)
+            return False
+        origins.append(spec.origin)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w") as f:
+            json.dump({"python": python, "origins": origins}, f)
+    except OSError as e:
+        print(e)
+    return True
+
+
 def import_module(module_name, global_name=None):
     """
     Import a module.
@@ -162,7 +200,7 @@ preference_classes = (SPLT_PT_warning_panel,
                       SPLT_OT_install_dependencies,
                       SPLT_preferences)
 classes = (RotateAndScale, PositionCamera,
-           PositionModel, FixMaterial, AddHRDI, RenderWiki, CheckRotateModel, SPLT_PT_Panel)
+           PositionModel, FixMaterial, AddHRDI, RenderWiki, CheckRotateModel, PreviewTurntable, SPLT_PT_Panel)
 
 dependencies_installed = False
 
@@ -193,25 +231,25 @@ def register():
     for cls in preference_classes:
         bpy.utils.register_class(cls)
 
-    try:
-        for dependency in dependencies:
-            import_module(module_name=dependency.module,
-                          global_name=dependency.name)
-        dependencies_installed = True
-    except ModuleNotFoundError as e:
-        print(e)
-        # Don't register other panels, operators etc.
-        pass
+    # The dependencies are imported by the operators that use them, this only
+    # checks they are there. Otherwise don't register other panels, operators etc.
+    with startup.stage('dependencies'):
+        dependencies_installed = check_dependencies()
 
     if(dependencies_installed):
-        for cls in classes:
-            bpy.utils.register_class(cls)
+        with startup.stage('register'):
+            for cls in classes:
+                bpy.utils.register_class(cls)
 
     # bpy.utils.register_class(SPLT_PT_Panel)
 
     mode_options = [
         ("JPEG", "JPEG", '', 'JPEG', 0),
         ("PNG", "PNG", '', 'PNG', 1),
+        ("PNG8", "PNG8", 'Paletted PNG with transparency, much smaller', 'PNG8', 2),
+        ("PNG_OPTIMIZED", "Optimized PNG", 'PNG trying every filter and zlib strategy, never larger than PNG', 'PNG_OPTIMIZED', 3),
+        ("WEBP", "WebP Lossless", 'Lossless WebP with transparency', 'WEBP', 4),
+        ("WEBP_LOSSY", "WebP", 'Lossy WebP with lossless transparency', 'WEBP_LOSSY', 5),
 
     ]
 
@@ -222,6 +260,24 @@ def register():
         name="Output Format"
     )
 
+    layout_options = [
+        ("STRIP", "Strip", 'All frames in a single row', 'STRIP', 0),
+        ("ATLAS", "Atlas", 'Frames packed into a near-square grid', 'ATLAS', 1),
+    ]
+
+    bpy.types.WindowManager.compare_formats = BoolProperty(
+        name="Compare Formats",
+        description="Also encode the sheet in every format and record sizes and times in the profile",
+        default=False
+    )
+
+    bpy.types.WindowManager.output_layout = bpy.props.EnumProperty(
+        items=layout_options,
+        description="Sheet Layout",
+        default=0,
+        name="Sheet Layout"
+    )
+
     bpy.types.WindowManager.objectselection_props = PointerProperty(
         name="Base armature",
         type=bpy.types.Object
@@ -244,6 +300,81 @@ def register():
         default=228,
         update=set_y_resolution
     )
+    bpy.types.WindowManager.preview_scale = IntProperty(
+        name="Preview Scale",
+        description="Percentage of the render resolution the turntable preview renders at",
+        default=25,
+        min=1,
+        max=100,
+        subtype='PERCENTAGE'
+    )
+    bpy.types.WindowManager.extra_dimensions = StringProperty(
+        name="Extra Sizes",
+        description="Comma-separated sizes to also write sheets for, such as 140, 70. Like the "
+                    "main size of 280, each is the longest side, width or height, of the largest frame",
+        default=""
+    )
+    bpy.types.WindowManager.memory_budget = IntProperty(
+        name="Memory Budget (MB)",
+        description="Frames held in memory before spilling to disk, 0 for no limit",
+        default=0,
+        min=0
+    )
+    bpy.types.WindowManager.stream_output = BoolProperty(
+        name="Stream Sheet",
+        description="Write the sheet strip by strip instead of building it in memory",
+        default=False
+    )
+    bpy.types.WindowManager.deduplicate_frames = BoolProperty(
+        name="Remove Duplicate Frames",
+        description="Store repeated frames once and point the offset map at the shared slot. "
+                    "Atlas layout only",
+        default=False
+    )
+    bpy.types.WindowManager.dedup_tolerance = IntProperty(
+        name="Duplicate Tolerance",
+        description="Largest per-channel difference for frames to count as duplicates",
+        default=0,
+        min=0,
+        max=255
+    )
+    bpy.types.WindowManager.use_render_border = BoolProperty(
+        name="Render Border",
+        description="Only render the part of each frame the model's bounds project to",
+        default=True
+    )
+    bpy.types.WindowManager.render_border_margin = IntProperty(
+        name="Border Margin",
+        description="Pixels added around the projected bounds, to keep anti-aliased edges",
+        default=4,
+        min=0
+    )
+    bpy.types.WindowManager.debug_write_frames = BoolProperty(
+        name="Write Frames to Disk",
+        description="Save every frame into the tmp folder and read it back, for debugging",
+        default=False
+    )
+    bpy.types.WindowManager.use_render_cache = BoolProperty(
+        name="Reuse Rendered Frames",
+        description="Skip frames whose pose, model, materials, world and render settings are unchanged",
+        default=True
+    )
+    bpy.types.WindowManager.render_workers = IntProperty(
+        name="Render Workers",
+        description="Background Blender processes to split the poses between, 1 renders here",
+        default=1,
+        min=1
+    )
+    bpy.types.WindowManager.pipelined_blend = BoolProperty(
+        name="Blend While Rendering",
+        description="Crop each finished frame in a background worker while the next one renders",
+        default=True
+    )
+    bpy.types.WindowManager.save_frame_archive = BoolProperty(
+        name="Save Frame Archive",
+        description="Keep the cropped frames in a single file to stitch again without rendering",
+        default=True
+    )
     bpy.types.WindowManager.output_folder = StringProperty(
         name="Output Folder",
         description="Path to Directory",
@@ -259,6 +390,11 @@ def register():
     )
 
     bpy.app.handlers.load_post.append(load_handler)
+    # Startup cost, also saved in every render's profile
+    stages = startup.seconds()
+    print("Splatoon Tools started in %.1f ms (%s)" % (
+        sum(stages.values()) * 1000,
+        ", ".join("%s %.1f ms" % (name, seconds * 1000) for name, seconds in stages.items())))
 
 
 def unregister():
@@ -278,5 +414,20 @@ def unregister():
     del bpy.types.WindowManager.output_folder
     del bpy.types.WindowManager.x_resolution
     del bpy.types.WindowManager.y_resolution
+    del bpy.types.WindowManager.preview_scale
+    del bpy.types.WindowManager.extra_dimensions
+    del bpy.types.WindowManager.memory_budget
+    del bpy.types.WindowManager.output_layout
+    del bpy.types.WindowManager.compare_formats
+    del bpy.types.WindowManager.stream_output
+    del bpy.types.WindowManager.deduplicate_frames
+    del bpy.types.WindowManager.dedup_tolerance
+    del bpy.types.WindowManager.use_render_border
+    del bpy.types.WindowManager.render_border_margin
+    del bpy.types.WindowManager.debug_write_frames
+    del bpy.types.WindowManager.pipelined_blend
+    del bpy.types.WindowManager.render_workers
+    del bpy.types.WindowManager.use_render_cache
+    del bpy.types.WindowManager.save_frame_archive
     del bpy.types.WindowManager.dependencies_installed
     bpy.app.handlers.load_post.remove(load_handler)
@@ -0,0 +1,247 @@
+"""
+Benchmarks the image pipeline on synthetic frames, without Blender.
+
+    python benchmark.py                 # run and compare with benchmark_baseline.json
+    python benchmark.py --save-baseline # run and store the results as the new baseline
+    python benchmark.py --quick         # a single small case
+
+PNG8's errors on soft edges are also checked against Pillow's octree quantizer.
+
+Every case runs in a fresh process so its peak memory is its own.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from numpy import absolute, asarray, float64
+from PIL import Image, ImageDraw, ImageFilter
+
+from ImageProcessor import ImageProcessor
+from encoders import encode_to_budget
+from profiling import peak_memory
+
+FRAME_COUNTS = (36, 108)
+RESOLUTIONS = ((296, 228), (592, 456), (1184, 912))
+FORMATS = ("PNG", "JPEG")
+# How much worse than Pillow's octree quantizer PNG8 may be on soft edges
+PALETTE_TOLERANCE = 1.25
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'benchmark_baseline.json')
+
+
+def synthetic_frame(size, rng):
+    """
+    A transparent frame with a randomly placed silhouette of a few opaque and
+    translucent shapes, with soft edges like an anti-aliased render.
+    """
+    width, height = size
+    image = Image.new('RGBA', size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    cx = rng.uniform(0.35, 0.65) * width
+    cy = rng.uniform(0.35, 0.65) * height
+    for _ in range(rng.randint(3, 7)):
+        w = rng.uniform(0.05, 0.3) * width
+        h = rng.uniform(0.05, 0.3) * height
+        x = cx + rng.uniform(-0.2, 0.2) * width
+        y = cy + rng.uniform(-0.2, 0.2) * height
+        colour = (rng.randint(0, 255), rng.randint(0, 255),
+                  rng.randint(0, 255), rng.choice((255, 255, 160)))
+        shape = rng.choice(('ellipse', 'rectangle', 'polygon'))
+        if shape == 'polygon':
+            draw.polygon([(x + rng.uniform(-w, w), y + rng.uniform(-h, h))
+                          for _ in range(rng.randint(3, 6))], fill=colour)
+        else:
+            getattr(draw, shape)((x - w, y - h, x + w, y + h), fill=colour)
+    alpha = image.getchannel('A').filter(ImageFilter.GaussianBlur(1))
+    image.putalpha(alpha)
+    return image
+
+
+def write_frames(directory, count, size, seed=0):
+    """
+    Writes count synthetic frames to directory and returns their paths in order.
+    """
+    rng = random.Random(seed)
+    files = []
+    for i in range(count):
+        filename = os.path.join(directory, 'render%d.png' % i)
+        synthetic_frame(size, rng).save(filename, compress_level=1)
+        files.append(filename)
+    return files
+
+
+def run_case(files, file_format, workers):
+    """
+    Times blending, stitching and a budgeted encode of one set of frames.
+    Meant to run in its own process.
+    """
+    output = tempfile.mkdtemp(prefix='splt_bench_')
+    try:
+        p = ImageProcessor(len(files) // 3, 1)
+        p.target_size = None
+
+        start = time.perf_counter()
+        if workers == 1:
+            for file in files:
+                p.blend(file)
+        else:
+            p.blend_many(files, workers)
+        blend = time.perf_counter() - start
+
+        start = time.perf_counter()
+        p.stitch_and_upload(output, file_format, workers=workers)
+        stitch = time.perf_counter() - start
+
+        sheet = Image.open(os.path.join(output, 'weapon.' + file_format.lower()))
+        sheet.load()
+        start = time.perf_counter()
+        data, _ = encode_to_budget(sheet, file_format, 512 * 1024, workers)
+        encode = time.perf_counter() - start
+        return {
+            'blend': blend,
+            'stitch': stitch,
+            'encode': encode,
+            'frames_per_second': len(files) / (blend + stitch),
+            'bytes': len(data),
+            'peak_memory': peak_memory(),
+            'stages': p.profiler.report()['stages'],
+        }
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+
+
+def run(frame_counts, resolutions, formats, workers):
+    """
+    Runs every combination of frame count, resolution and format.
+    Returns a dict of results keyed by case name.
+    """
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for count in frame_counts:
+        for size in resolutions:
+            directory = tempfile.mkdtemp(prefix='splt_frames_')
+            try:
+                files = write_frames(directory, count, size)
+                for file_format in formats:
+                    name = '%d frames %dx%d %s' % (count, size[0], size[1], file_format)
+                    with ProcessPoolExecutor(1, mp_context=context) as pool:
+                        results[name] = pool.submit(
+                            run_case, files, file_format, workers).result()
+                    report(name, results[name])
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def translucent_error(original, quantized):
+    """
+    Mean absolute alpha, colour and premultiplied colour errors of quantized
+    over the pixels of original that are neither transparent nor opaque.
+    """
+    a = asarray(original.convert('RGBA'), dtype=float64)
+    b = asarray(quantized.convert('RGBA'), dtype=float64)
+    translucent = (a[..., 3] > 0) & (a[..., 3] < 255)
+    a, b = a[translucent], b[translucent]
+    return (absolute(a[:, 3] - b[:, 3]).mean(),
+            absolute(a[:, :3] - b[:, :3]).mean(),
+            absolute(a[:, :3] * a[:, 3:] - b[:, :3] * b[:, 3:]).mean() / 255)
+
+
+def check_palette(workers):
+    """
+    Stitches 36 synthetic frames into an atlas as PNG and as PNG8, and
+    compares the PNG8 sheet's errors on translucent pixels with those of
+    Pillow's octree quantizer on the PNG sheet. Returns how many of them are
+    more than PALETTE_TOLERANCE times octree's.
+    """
+    directory = tempfile.mkdtemp(prefix='splt_frames_')
+    try:
+        files = write_frames(directory, FRAME_COUNTS[0], RESOLUTIONS[0])
+        sheets = {}
+        for file_format in ("PNG", "PNG8"):
+            p = ImageProcessor(len(files) // 3, 1)
+            p.target_size = None
+            p.blend_many(files, workers)
+            p.stitch_and_upload(directory, file_format, "ATLAS", workers=workers)
+            sheets[file_format] = Image.open(os.path.join(directory, 'weapon.png'))
+            sheets[file_format].load()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    octree = translucent_error(sheets["PNG"], sheets["PNG"].quantize(
+        256, method=Image.Quantize.FASTOCTREE))
+    ours = translucent_error(sheets["PNG"], sheets["PNG8"])
+    failures = 0
+    for name, error, limit in zip(('alpha', 'colour', 'premultiplied'), ours, octree):
+        print('PNG8 %-13s error %5.2f, octree %5.2f' % (name, error, limit))
+        if error > limit * PALETTE_TOLERANCE:
+            print('REGRESSION PNG8 %s error on translucent pixels' % name)
+            failures += 1
+    return failures
+
+
+def report(name, result):
+    memory = result['peak_memory']
+    print('%-28s blend %7.3fs  stitch %7.3fs  encode %7.3fs  %7.1f frames/s  %8s peak' % (
+        name, result['blend'], result['stitch'], result['encode'],
+        result['frames_per_second'],
+        '%.1fMB' % (memory / 2**20) if memory else '?'))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints every stage time or peak memory that grew by more than tolerance
+    over the baseline. Returns the number of regressions.
+    """
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ('blend', 'stitch', 'encode', 'peak_memory'):
+            old, new = baseline[name].get(key), result.get(key)
+            if old and new and new > old * (1 + tolerance):
+                print('REGRESSION %s %s: %.4g -> %.4g (+%.0f%%)' % (
+                    name, key, old, new, 100 * (new / old - 1)))
+                regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--quick', action='store_true',
+                        help='only run 36 frames at the smallest resolution as PNG')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker count for blending, resizing and encoding, 1 blends serially')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='allowed growth over the baseline, 0.15 is 15%%')
+    args = parser.parse_args()
+
+    if args.quick:
+        results = run(FRAME_COUNTS[:1], RESOLUTIONS[:1], FORMATS[:1], args.workers)
+    else:
+        results = run(FRAME_COUNTS, RESOLUTIONS, FORMATS, args.workers)
+    # Quality rather than speed, so checked against octree instead of the baseline
+    failures = check_palette(args.workers)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved baseline to ' + args.baseline)
+        return 1 if failures else 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, run with --save-baseline to store one' % args.baseline)
+        return 1 if failures else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    return 1 if compare(results, baseline, args.tolerance) or failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+import struct
+import time
+import zlib
+from numpy import abs as absolute, argmin, asarray, empty, int16, stack, uint8, where, zeros_like
+try:
+    from PIL import ImageFile, features
+except ModuleNotFoundError:
+    print("Could not find PIL")
+try:
+    from . quantize import PALETTE_SAMPLES, build_palette, quantize_image, sample_pixels
+except ImportError:
+    from quantize import PALETTE_SAMPLES, build_palette, quantize_image, sample_pixels
+
+# Best quality first, the search stops degrading at the first one that fits
+JPEG_QUALITIES = (95, 90, 85, 80, 75, 70, 60, 50, 40)
+# zlib strategies Pillow passes through as compress_type: default, filtered and RLE
+PNG_STRATEGIES = (0, 1, 3)
+PNG_LEVELS = (6, 9)
+# PNG scanline filters: the best per row, or none, Sub, Up, Average and Paeth.
+# The first is what save_png uses without a size target
+PNG_FILTERS = ('adaptive', 0, 1, 2, 3, 4)
+# Compression effort for lossless WebP as (quality, method). Method 6 is
+# around ten times slower than 4 for a few percent, so it isn't tried
+WEBP_EFFORTS = ((75, 4), (100, 4))
+WEBP_QUALITIES = (95, 90, 85, 80, 75, 70, 60, 50)
+
+# How to write an output format. save(image, options) returns the encoded
+# bytes and candidates() the options to try as (rank, options), lower ranks
+# being better quality, the first being the default. Formats without alpha are
+# given RGB images and palette ones quantized images, see prepare. feature is
+# the Pillow feature needed. save_all(image, options, pool), if set, encodes a
+# list of options at once, sharing work between them.
+Encoder = namedtuple('Encoder', ['extension', 'alpha', 'palette', 'candidates', 'save', 'feature',
+                                 'save_all'])
+ENCODERS = {}
+
+
+def register_encoder(name, extension, candidates, save, alpha=True, palette=False, feature=None,
+                     save_all=None):
+    ENCODERS[name] = Encoder(extension, alpha, palette, candidates, save, feature, save_all)
+
+
+def available(file_format):
+    """
+    Whether this Pillow build can write file_format.
+    """
+    feature = ENCODERS[file_format].feature
+    return feature is None or features.check(feature)
+
+
+def extension(file_format):
+    """
+    The file extension of an output format.
+    """
+    return ENCODERS[file_format].extension
+
+
+def jpeg_candidates():
+    """
+    Save options to try for a JPEG as (rank, options), lower ranks being better quality.
+    """
+    return [(rank, {'quality': quality, 'optimize': True, 'progressive': progressive})
+            for rank, quality in enumerate(JPEG_QUALITIES)
+            for progressive in (True, False)]
+
+
+def png_candidates():
+    """
+    Save options to try for a PNG as (rank, options). PNG is lossless so every
+    candidate has the same rank and only the size matters.
+    """
+    return [(0, {'compress_level': level, 'compress_type': strategy})
+            for level in PNG_LEVELS
+            for strategy in PNG_STRATEGIES]
+
+
+def optimized_png_candidates():
+    """
+    Every scanline filter with every zlib strategy at the highest level, for
+    save_png, then Pillow's own PNG candidates, so the result is never larger
+    than plain PNG's. All lossless, so the smallest wins.
+    """
+    return [(0, {'filter_type': filter_type, 'strategy': strategy})
+            for filter_type in PNG_FILTERS
+            for strategy in PNG_STRATEGIES] + png_candidates()
+
+
+def webp_candidates():
+    """
+    Lossless WebP at a couple of compression efforts.
+    """
+    return [(0, {'lossless': True, 'quality': quality, 'method': method})
+            for quality, method in WEBP_EFFORTS]
+
+
+def webp_lossy_candidates():
+    """
+    Lossy WebP colour with lossless alpha, best quality first.
+    """
+    return [(rank, {'quality': quality, 'method': 4, 'alpha_quality': 100})
+            for rank, quality in enumerate(WEBP_QUALITIES)]
+
+
+def pillow_save(pil_format, image, options):
+    """
+    Encodes image with Pillow into an in-memory file and returns its bytes.
+    """
+    buffer = BytesIO()
+    # Pillow keeps the save options on the image while saving, so candidates
+    # encoded in parallel each save their own copy
+    image.copy().save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+def png_filter(rows, bpp, filter_type, filtered=None):
+    """
+    Filters a (height, width * bpp) uint8 array of scanlines with a PNG filter
+    type, or on each row the one whose output has the smallest sum of absolute
+    values for 'adaptive'. Returns the filter type of every row and the
+    filtered rows. The filters only look at unfiltered neighbours, so every
+    row is filtered at once. 'adaptive' chooses from filtered, the rows
+    already filtered with types 0 to 4, if given.
+    """
+    if filter_type == 'adaptive':
+        if filtered is None:
+            filtered = [png_filter(rows, bpp, f)[1] for f in range(5)]
+        filtered = stack(filtered)
+        # Read as signed bytes: small magnitudes compress best
+        costs = absolute(filtered.view('int8').astype(int16)).sum(axis=2)
+        best = argmin(costs, axis=0)
+        return best.astype(uint8), filtered[best, range(len(rows))]
+    types = empty(len(rows), dtype=uint8)
+    types[:] = filter_type
+    if filter_type == 0:
+        return types, rows
+    # uint8 arithmetic wraps around, which is what the filters want
+    left = zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    up = zeros_like(rows)
+    up[1:] = rows[:-1]
+    if filter_type == 1:
+        return types, rows - left
+    if filter_type == 2:
+        return types, rows - up
+    if filter_type == 3:
+        return types, rows - ((left.astype(int16) + up) >> 1).astype(uint8)
+    up_left = zeros_like(rows)
+    up_left[1:] = left[:-1]
+    a, b, c = left.astype(int16), up.astype(int16), up_left.astype(int16)
+    p = a + b - c
+    pa, pb, pc = absolute(p - a), absolute(p - b), absolute(p - c)
+    predictor = where((pa <= pb) & (pa <= pc), a, where(pb <= pc, b, c))
+    return types, rows - predictor.astype(uint8)
+
+
+def write_png_chunk(file, chunk_type, data):
+    """
+    Writes one length-prefixed, CRC-suffixed PNG chunk.
+    """
+    file.write(struct.pack('>I', len(data)))
+    file.write(chunk_type)
+    file.write(data)
+    file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+# PNG colour type and bytes per pixel of the modes save_png writes as they are
+PNG_MODES = {'L': (0, 1), 'RGB': (2, 3), 'P': (3, 1), 'LA': (4, 2), 'RGBA': (6, 4)}
+
+
+def png_rows(image):
+    """
+    image in a mode PNG_MODES holds, and its pixels as a (height, width * bpp)
+    uint8 array of scanlines for png_filter.
+    """
+    if image.mode not in PNG_MODES:
+        image = image.convert('RGBA')
+    bpp = PNG_MODES[image.mode][1]
+    return image, asarray(image, dtype=uint8).reshape(image.height, image.width * bpp)
+
+
+def png_scanlines(types, filtered):
+    """
+    The filtered rows from png_filter, each behind its filter type byte, as
+    the bytes zlib compresses into a PNG.
+    """
+    scanlines = empty((len(filtered), filtered.shape[1] + 1), dtype=uint8)
+    scanlines[:, 0] = types
+    scanlines[:, 1:] = filtered
+    return scanlines.tobytes()
+
+
+def png_file(image, scanlines, options):
+    """
+    Compresses scanlines from png_scanlines with zlib at the level and
+    strategy options and writes them as a PNG of image, which must be in one
+    of PNG_MODES. Palette images keep their palette and transparency.
+    """
+    compressor = zlib.compressobj(options.get('level', 9), zlib.DEFLATED, 15, 9,
+                                  options.get('strategy', 0))
+    buffer = BytesIO()
+    buffer.write(b'\x89PNG\r\n\x1a\n')
+    write_png_chunk(buffer, b'IHDR', struct.pack(
+        '>IIBBBBB', image.width, image.height, 8, PNG_MODES[image.mode][0], 0, 0, 0))
+    if image.mode == 'P':
+        write_png_chunk(buffer, b'PLTE', bytes(image.getpalette()))
+        transparency = image.info.get('transparency')
+        if isinstance(transparency, int):
+            transparency = b'\xff' * transparency + b'\x00'
+        if transparency:
+            # Entries past the end of tRNS are opaque
+            write_png_chunk(buffer, b'tRNS', transparency.rstrip(b'\xff') or b'\xff')
+    write_png_chunk(buffer, b'IDAT', compressor.compress(scanlines) + compressor.flush())
+    write_png_chunk(buffer, b'IEND', b'')
+    return buffer.getvalue()
+
+
+def save_png(image, options):
+    """
+    Encodes image as a PNG filtered with png_filter and compressed with zlib,
+    taking filter_type, level and strategy options. Palette images keep their
+    palette and transparency. Options with a compress_level are Pillow's, see
+    png_candidates, and are saved with Pillow instead.
+    """
+    if 'compress_level' in options:
+        return pillow_save("PNG", image, options)
+    image, rows = png_rows(image)
+    bpp = PNG_MODES[image.mode][1]
+    types, filtered = png_filter(rows, bpp, options.get('filter_type', 'adaptive'))
+    return png_file(image, png_scanlines(types, filtered), options)
+
+
+def save_png_all(image, options, pool):
+    """
+    Encodes image with every set of save_png options, filtering the
+    scanlines once for each filter type, with 'adaptive' choosing between
+    the other filters' rows, and compressing them for each zlib setting.
+    Pillow's options are saved with Pillow alongside.
+    """
+    pillow = {i: pool.submit(pillow_save, "PNG", image, candidate)
+              for i, candidate in enumerate(options) if 'compress_level' in candidate}
+    own = [candidate for i, candidate in enumerate(options) if i not in pillow]
+    image, rows = png_rows(image)
+    bpp = PNG_MODES[image.mode][1]
+    filter_types = []
+    for candidate in own:
+        filter_type = candidate.get('filter_type', 'adaptive')
+        if filter_type not in filter_types:
+            filter_types.append(filter_type)
+    basic = range(5) if 'adaptive' in filter_types else [f for f in filter_types if f != 'adaptive']
+    filtered = dict(zip(basic, pool.map(lambda f: png_filter(rows, bpp, f), basic)))
+    if 'adaptive' in filter_types:
+        filtered['adaptive'] = png_filter(rows, bpp, 'adaptive', [filtered[f][1] for f in range(5)])
+    scanlines = {f: png_scanlines(*filtered[f]) for f in filter_types}
+    encoded = iter(list(pool.map(lambda candidate: png_file(
+        image, scanlines[candidate.get('filter_type', 'adaptive')], candidate), own)))
+    return [pillow[i].result() if i in pillow else next(encoded) for i in range(len(options))]
+
+
+register_encoder("JPEG", "jpeg", jpeg_candidates, partial(pillow_save, "JPEG"), alpha=False)
+register_encoder("PNG", "png", png_candidates, partial(pillow_save, "PNG"))
+register_encoder("PNG_OPTIMIZED", "png", optimized_png_candidates, save_png,
+                 save_all=save_png_all)
+register_encoder("PNG8", "png", optimized_png_candidates, save_png, palette=True,
+                 save_all=save_png_all)
+register_encoder("WEBP", "webp", webp_candidates, partial(pillow_save, "WEBP"),
+                 feature='webp')
+register_encoder("WEBP_LOSSY", "webp", webp_lossy_candidates, partial(pillow_save, "WEBP"),
+                 feature='webp')
+
+
+def prepare(image, file_format, samples=None):
+    """
+    Converts an RGBA sheet into what file_format saves: RGB for formats without
+    alpha, or quantized for palette formats with a palette fitted to samples of
+    pixels, see build_palette, or to the sheet itself if there are none.
+    """
+    encoder = ENCODERS[file_format]
+    if encoder.palette and image.mode != 'P':
+        if not samples:
+            samples = [sample_pixels(image, PALETTE_SAMPLES)]
+        return quantize_image(image, build_palette(samples))
+    if not encoder.alpha and image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def encode(image, file_format, options):
+    """
+    Encodes image as file_format and returns its bytes.
+    """
+    if not available(file_format):
+        raise ValueError('This Pillow build cannot write ' + file_format)
+    return ENCODERS[file_format].save(image, options)
+
+
+def encode_to_budget(image, file_format, target_size, workers=None):
+    """
+    Encodes image with every candidate set of options for its format, in
+    parallel on a pool of threads, and returns (data, options) for the best
+    result that fits in target_size bytes: the best quality rank that fits,
+    then the smallest. If nothing fits the smallest result is returned.
+    A target_size of None encodes once with the format's first candidate.
+    """
+    if target_size is None:
+        options = ENCODERS[file_format].candidates()[0][1]
+        return encode(image, file_format, options), options
+
+    # Ensure there is enough allocated space to save the image as progressive
+    ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK,
+                             image.height * image.width * 16)
+
+    encoder = ENCODERS[file_format]
+    candidates = encoder.candidates()
+    with ThreadPoolExecutor(workers) as pool:
+        if encoder.save_all is not None:
+            encoded = encoder.save_all(image, [options for _, options in candidates], pool)
+        else:
+            encoded = list(pool.map(
+                lambda candidate: encode(image, file_format, candidate[1]), candidates))
+
+    results = [(rank, len(data), i) for i, ((rank, _), data)
+               in enumerate(zip(candidates, encoded))]
+    fitting = [result for result in results if result[1] <= target_size]
+    if fitting:
+        best = min(fitting)
+    else:
+        best = min(results, key=lambda result: result[1])
+    return encoded[best[2]], candidates[best[2]][1]
+
+
+def measure_encoders(image, target_size, workers=None, file_formats=None, samples=None):
+    """
+    Encodes an RGBA sheet with every available format, or those given, the
+    way stitch_and_upload would. Returns each format's size in bytes, seconds
+    taken including any conversion, and the options chosen.
+    """
+    results = []
+    for file_format in file_formats or ENCODERS:
+        if not available(file_format):
+            continue
+        start = time.perf_counter()
+        data, options = encode_to_budget(
+            prepare(image, file_format, samples), file_format, target_size, workers)
+        results.append({
+            'format': file_format,
+            'bytes': len(data),
+            'seconds': time.perf_counter() - start,
+            'options': options,
+        })
+    return results
+
+
+def write_png(file, size, bands, compress_level=6):
+    """
+    Streams an RGBA PNG of the given size to file from (top, image) bands given
+    top to bottom, so only one band of scanlines is in memory at a time.
+    Every scanline uses the Sub filter, see png_filter.
+    """
+    file.write(b'\x89PNG\r\n\x1a\n')
+    write_png_chunk(file, b'IHDR', struct.pack(
+        '>IIBBBBB', size[0], size[1], 8, 6, 0, 0, 0))
+    compressor = zlib.compressobj(compress_level)
+    for _, band in bands:
+        rows = asarray(band, dtype=uint8).reshape(band.height, -1)
+        scanlines = empty((band.height, rows.shape[1] + 1), dtype=uint8)
+        scanlines[:, 0], scanlines[:, 1:] = png_filter(rows, 4, 1)
+        data = compressor.compress(scanlines.tobytes())
+        if data:
+            write_png_chunk(file, b'IDAT', data)
+    write_png_chunk(file, b'IDAT', compressor.flush())
+    write_png_chunk(file, b'IEND', b'')
@@ -0,0 +1,84 @@
+import json
+import mmap
+import struct
+try:
+    from PIL import Image
+except ModuleNotFoundError:
+    print("Could not find PIL")
+
+MAGIC = b'SPLTFRM1'
+# Magic, then the offset and length of the JSON index at the end of the file
+HEADER = struct.Struct('<8sQQ')
+
+
+def write_archive(filename, frames, boxes, y_rotations, x_rotations):
+    """
+    Writes cropped frames into a single archive file: a header, the raw pixels
+    of every frame one after the other, then a JSON index giving each frame's
+    (step, tilt), crop box, size and offset in the file.
+    frames and boxes are in sheet order, x_rotations frames per rotation step.
+    """
+    index = {'y_rotations': y_rotations, 'x_rotations': x_rotations, 'frames': []}
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        for i, (image, box) in enumerate(zip(frames, boxes)):
+            data = image.tobytes()
+            index['frames'].append({
+                'step': i // x_rotations,
+                'tilt': i % x_rotations,
+                'box': list(box),
+                'mode': image.mode,
+                'size': list(image.size),
+                'offset': f.tell(),
+            })
+            f.write(data)
+        index_offset = f.tell()
+        data = json.dumps(index).encode('utf-8')
+        f.write(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, index_offset, len(data)))
+
+
+class FrameArchive(object):
+    """
+    A frame archive written by write_archive, memory-mapped so frames are read
+    straight out of the page cache rather than copied into memory.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a frame archive' % filename)
+        index = json.loads(self.map[index_offset:index_offset + index_length].decode('utf-8'))
+        self.y_rotations = index['y_rotations']
+        self.x_rotations = index['x_rotations']
+        self.frames = index['frames']
+
+    def __len__(self):
+        return len(self.frames)
+
+    def box(self, i):
+        return tuple(self.frames[i]['box'])
+
+    def key(self, i):
+        """
+        The (rotation step, tilt) of frame i.
+        """
+        return self.frames[i]['step'], self.frames[i]['tilt']
+
+    def frame(self, i):
+        """
+        Frame i as a PIL image backed by the memory map, without a copy.
+        """
+        entry = self.frames[i]
+        size = tuple(entry['size'])
+        length = size[0] * size[1] * len(entry['mode'])
+        data = memoryview(self.map)[entry['offset']:entry['offset'] + length]
+        return Image.frombuffer(entry['mode'], size, data, 'raw', entry['mode'], 0, 1)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
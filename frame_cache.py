@@ -0,0 +1,51 @@
+import json
+import os
+try:
+    from PIL import Image
+except ModuleNotFoundError:
+    print("Could not find PIL")
+
+
+class FrameCache(object):
+    """
+    Cropped frames kept on disk under a key hashing everything that went into
+    rendering them, so a frame whose key is unchanged need not be rendered again.
+    Each frame is a PNG named by its key and the crop boxes are in index.json,
+    which is replaced after every frame so an interrupted job keeps what it
+    finished.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.index_file = os.path.join(directory, 'index.json')
+        self.boxes = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.boxes = json.load(f)
+
+    def __contains__(self, key):
+        return key in self.boxes and os.path.exists(self.path(key))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def box(self, key):
+        return tuple(self.boxes[key])
+
+    def load(self, key):
+        image = Image.open(self.path(key))
+        image.load()
+        return image
+
+    def put(self, key, box, image):
+        """
+        Stores a cropped frame and its crop box under key.
+        """
+        image.save(self.path(key), compress_level=1)
+        self.boxes[key] = list(box)
+        temporary = self.index_file + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.boxes, f)
+        os.replace(temporary, self.index_file)
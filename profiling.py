@@ -0,0 +1,151 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+
+def peak_memory():
+    """
+    Peak resident memory of this process in bytes, or None if unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        return windows_peak_memory()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def windows_peak_memory():
+    try:
+        import ctypes
+        from ctypes import wintypes
+    except ImportError:
+        return None
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD),
+                    ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t),
+                    ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t),
+                    ('PeakPagefileUsage', ctypes.c_size_t)]
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+class Profiler(object):
+    """
+    Records the calls, wall time and peak memory of named stages of a job.
+    Peak memory is the process high-water mark when a stage ends, and growth
+    the most a single call of the stage raised it, which points at the stage
+    that set the peak. Stages running on several threads at once add up their
+    times, so those can exceed the wall time of the job.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.info = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the body of a with statement as one call of the named stage.
+        """
+        before = peak_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, before)
+
+    def wrap(self, name, function):
+        """
+        Returns function with every call timed as the named stage.
+        """
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def iterate(self, name, iterable):
+        """
+        Yields from iterable with the time taken to produce each item timed as
+        the named stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, name, seconds, memory_before=None):
+        """
+        Adds one call of the named stage, for times measured elsewhere such as
+        in a worker process.
+        """
+        after = peak_memory()
+        with self.lock:
+            stage = self.stages.setdefault(name, {
+                'calls': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'peak_memory': None,
+                'memory_growth': 0,
+            })
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            if after is not None:
+                stage['peak_memory'] = after
+                if memory_before is not None:
+                    stage['memory_growth'] = max(
+                        stage['memory_growth'], after - memory_before)
+
+    def report(self):
+        """
+        The recorded stages and job info as a JSON-serialisable dict.
+        """
+        with self.lock:
+            return {
+                'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'wall_seconds': time.perf_counter() - self.started,
+                'peak_memory': peak_memory(),
+                'info': dict(self.info),
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+            }
+
+    def seconds(self):
+        """
+        The total seconds of each recorded stage.
+        """
+        with self.lock:
+            return {name: stage['seconds'] for name, stage in self.stages.items()}
+
+    def write(self, directory, filename='weaponprofile.json'):
+        """
+        Writes the report as JSON into directory.
+        """
+        with open(os.path.join(directory, filename), 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+# Loading and registering the add-on, see register in __init__.py
+startup = Profiler()
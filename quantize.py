@@ -0,0 +1,75 @@
+from numpy import (asarray, bincount, concatenate, empty, float32, intp, rint, unique,
+                   vstack, zeros, uint8)
+from numpy.random import default_rng
+try:
+    from PIL import Image
+except ModuleNotFoundError:
+    print("Could not find PIL")
+
+# Pixels sampled across all the frames of a sheet to fit the palette to
+PALETTE_SAMPLES = 65536
+
+
+def sample_pixels(image, count, seed=0):
+    """
+    Up to count randomly chosen visible pixels of an RGBA image as an (n, 4) array.
+    """
+    pixels = asarray(image).reshape(-1, 4)
+    visible = pixels[pixels[:, 3] > 0]
+    if len(visible) > count:
+        visible = visible[default_rng(seed).choice(len(visible), count, replace=False)]
+    return visible
+
+
+def nearest(pixels, palette, chunk=65536):
+    """
+    The index of the closest palette entry to every RGBA pixel, compared in
+    chunks so the distance matrix stays small.
+    """
+    palette = palette.astype(float32)
+    norms = (palette * palette).sum(axis=1)
+    labels = empty(len(pixels), dtype=intp)
+    for start in range(0, len(pixels), chunk):
+        block = pixels[start:start + chunk].astype(float32)
+        # The pixel's own norm is the same for every entry, so it is left out
+        labels[start:start + chunk] = (norms - 2 * block @ palette.T).argmin(axis=1)
+    return labels
+
+
+def build_palette(samples, colours=256, iterations=10, seed=0):
+    """
+    An RGBA palette of up to colours entries fitted to the sampled pixels with
+    k-means, as a (n, 4) uint8 array. Entry 0 is always fully transparent.
+    If the samples hold fewer colours than that they are the palette as is.
+    """
+    samples = concatenate(samples)
+    distinct = unique(samples, axis=0)
+    if len(distinct) < colours:
+        return vstack([zeros((1, 4), dtype=uint8), distinct])
+    samples = samples.astype(float32)
+    centres = distinct[default_rng(seed).choice(
+        len(distinct), colours - 1, replace=False)].astype(float32)
+    for _ in range(iterations):
+        labels = nearest(samples, centres)
+        counts = bincount(labels, minlength=len(centres))
+        used = counts > 0
+        for channel in range(4):
+            sums = bincount(labels, samples[:, channel], minlength=len(centres))
+            centres[used, channel] = sums[used] / counts[used]
+    return vstack([zeros((1, 4), dtype=uint8), rint(centres).clip(0, 255).astype(uint8)])
+
+
+def quantize_image(image, palette):
+    """
+    Maps an RGBA image onto an RGBA palette from build_palette, giving a P mode
+    image whose palette alphas are saved as a PNG tRNS chunk. Fully transparent
+    pixels all take entry 0.
+    """
+    pixels = asarray(image).reshape(-1, 4)
+    indices = zeros(len(pixels), dtype=uint8)
+    visible = pixels[:, 3] > 0
+    indices[visible] = nearest(pixels[visible], palette[1:]) + 1
+    result = Image.frombytes('P', image.size, indices.tobytes())
+    result.putpalette(palette[:, :3].tobytes())
+    result.info['transparency'] = palette[:, 3].tobytes()
+    return result
@@ -0,0 +1,151 @@
+import bpy
+from math import radians, sqrt
+from mathutils import Vector
+from numpy import (abs as absolute, array, concatenate, cos, empty, float32, float64, hypot,
+                   maximum, minimum, sin)
+
+# Extents and fits are cached per model and transform, up to this many entries
+CACHE_SIZE = 64
+_cache = {}
+
+
+def transform_key(obj):
+    """
+    Identifies a model and the transforms of its child meshes, so cached results
+    are dropped as soon as anything moves.
+    """
+    return (obj.as_pointer(),) + tuple(
+        (child.as_pointer(), tuple(value for row in child.matrix_world for value in row))
+        for child in obj.children if child.type == 'MESH')
+
+
+def cached(key, compute):
+    if key not in _cache:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[key] = compute()
+    return _cache[key]
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def world_points(obj, depsgraph=None):
+    """
+    World-space vertex positions of all the model's child meshes as an (n, 3)
+    array, read in bulk with foreach_get from the evaluated meshes so the
+    armature pose and modifiers are included.
+    """
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+    points = []
+    for child in obj.children:
+        if child.type != 'MESH':
+            continue
+        evaluated = child.evaluated_get(depsgraph)
+        mesh = evaluated.to_mesh()
+        try:
+            coords = empty(len(mesh.vertices) * 3, dtype=float32)
+            mesh.vertices.foreach_get('co', coords)
+        finally:
+            evaluated.to_mesh_clear()
+        matrix = array(evaluated.matrix_world, dtype=float64)
+        points.append(coords.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3])
+    if not points:
+        return empty((0, 3))
+    return concatenate(points)
+
+
+def model_bounds(obj):
+    """
+    The world-space (minimum, maximum) corners of the model's child meshes as
+    Vectors, or None if it has no meshes.
+    """
+    def compute():
+        points = world_points(obj)
+        if not len(points):
+            return None
+        return Vector(points.min(axis=0)), Vector(points.max(axis=0))
+    return cached(('bounds',) + transform_key(obj), compute)
+
+
+def view_tangents(scene):
+    """
+    Tangents of the camera's horizontal and vertical half angles of view at the
+    scene's render aspect.
+    """
+    camera = scene.camera.data
+    render = scene.render
+    width = render.resolution_x * render.pixel_aspect_x
+    height = render.resolution_y * render.pixel_aspect_y
+    fit = camera.sensor_fit
+    if fit == 'AUTO':
+        fit = 'HORIZONTAL' if width >= height else 'VERTICAL'
+        sensor = camera.sensor_width
+    else:
+        sensor = camera.sensor_width if fit == 'HORIZONTAL' else camera.sensor_height
+    tangent = sensor / (2 * camera.lens)
+    if fit == 'HORIZONTAL':
+        return tangent, tangent * height / width
+    return tangent * width / height, tangent
+
+
+def turntable_extents(points, centre, tilt):
+    """
+    Bounds of the model over a full turn about the vertical axis through centre
+    combined with no tilt or a tilt of tilt radians either way about any
+    horizontal axis through it, as the turntable renders it: the largest
+    distance from the axis, and the lowest and highest point relative to centre.
+    """
+    offsets = points - array(centre, dtype=float64)
+    radii = hypot(offsets[:, 0], offsets[:, 1])
+    heights = offsets[:, 2]
+    # Tilting moves a point's height by at most its radius times sin(tilt),
+    # and its radius by at most its height times sin(tilt). The untilted
+    # frames count too: a point below the centre near the axis rises when
+    # tilted, so it is lowest untilted
+    radius = (radii + absolute(heights) * sin(tilt)).max()
+    bottom = minimum(heights, heights * cos(tilt) - radii * sin(tilt)).min()
+    top = maximum(heights, heights * cos(tilt) + radii * sin(tilt)).max()
+    return float(radius), float(bottom), float(top)
+
+
+def camera_fit(obj, scene, centre, tilt=radians(15), padding=0.02):
+    """
+    Where the camera, looking along +Y, has to be to keep every frame of the
+    turntable in view, as (location, ortho_scale, clip_end). ortho_scale is
+    None for perspective cameras. Returns None if the model has no meshes.
+    """
+    camera = scene.camera.data
+    render = scene.render
+    key = ('fit', tuple(centre), tilt, padding, camera.type, camera.lens,
+           camera.sensor_fit, camera.sensor_width, camera.sensor_height,
+           render.resolution_x, render.resolution_y) + transform_key(obj)
+
+    def compute():
+        points = world_points(obj)
+        if not len(points):
+            return None
+        radius, bottom, top = turntable_extents(points, centre, tilt)
+        radius *= 1 + padding
+        half_height = (top - bottom) / 2 * (1 + padding)
+        height = centre[2] + (top + bottom) / 2
+        if camera.type == 'ORTHO':
+            width = render.resolution_x * render.pixel_aspect_x
+            aspect = render.resolution_y * render.pixel_aspect_y / width
+            if aspect <= 1:
+                ortho_scale = max(2 * radius, 2 * half_height / aspect)
+            else:
+                ortho_scale = max(2 * half_height, 2 * radius * aspect)
+            distance = radius + camera.clip_start + 1
+        else:
+            ortho_scale = None
+            tan_x, tan_y = view_tangents(scene)
+            # The turntable sweeps a cylinder: its sides touch the horizontal
+            # edges of the view and its near face the vertical ones
+            distance = max(radius * sqrt(1 + tan_x * tan_x) / tan_x,
+                           radius + half_height / tan_y)
+        location = Vector((centre[0], centre[1] - distance, height))
+        return location, ortho_scale, distance + radius
+    return cached(key, compute)
@@ -0,0 +1,155 @@
+import bpy
+import hashlib
+import os
+from numpy import empty, float32, int32
+
+# Bump when the way frames are rendered or blended changes, to drop old frames
+CACHE_VERSION = 1
+# Settings that change every frame or only affect the interface
+VOLATILE = {'filepath', 'use_border', 'use_crop_to_border', 'border_min_x', 'border_min_y',
+            'border_max_x', 'border_max_y', 'location', 'width', 'width_hidden', 'height',
+            'dimensions', 'select', 'show_options', 'show_preview', 'show_texture', 'hide'}
+
+
+def plain(value):
+    """
+    value as nested lists of Python numbers and strings, whose repr is stable.
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, bpy.types.ID):
+        return value.name_full
+    if isinstance(value, set):
+        return sorted(value)
+    try:
+        return [plain(item) for item in value]
+    except TypeError:
+        return repr(value)
+
+
+def settings(owner):
+    """
+    The values of owner's own properties, leaving out pointers and collections.
+    """
+    return [(prop.identifier, plain(getattr(owner, prop.identifier, None)))
+            for prop in owner.bl_rna.properties
+            if prop.identifier != 'rna_type' and prop.identifier not in VOLATILE
+            and prop.type not in {'POINTER', 'COLLECTION'}]
+
+
+def curve_values(mapping):
+    """
+    The settings and the points of every curve of a CurveMapping, which
+    settings leaves out as a pointer.
+    """
+    if mapping is None:
+        return None
+    return [settings(mapping), [[(plain(point.location), point.handle_type) for point in curve.points]
+                                for curve in mapping.curves]]
+
+
+def node_tree_values(tree):
+    """
+    The nodes, socket values and links of a node tree. Images are identified by
+    their file and its modification time.
+    """
+    if tree is None:
+        return None
+    values = []
+    for node in sorted(tree.nodes, key=lambda node: node.name):
+        values.append((node.bl_idname, node.name, settings(node),
+                       [plain(getattr(socket, 'default_value', None)) for socket in node.inputs],
+                       curve_values(getattr(node, 'mapping', None))))
+        image = getattr(node, 'image', None)
+        if image is not None:
+            filepath = bpy.path.abspath(image.filepath)
+            values.append((image.name_full, filepath, image.source, image.packed_file is not None,
+                           os.path.getmtime(filepath) if os.path.exists(filepath) else None))
+    values.append(sorted((link.from_node.name, link.from_socket.identifier,
+                          link.to_node.name, link.to_socket.identifier) for link in tree.links))
+    return values
+
+
+def mesh_digest(hasher, obj, depsgraph):
+    """
+    Adds the evaluated geometry of a mesh object to hasher, read in bulk with
+    foreach_get, and its materials.
+    """
+    evaluated = obj.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        coords = empty(len(mesh.vertices) * 3, dtype=float32)
+        mesh.vertices.foreach_get('co', coords)
+        loops = empty(len(mesh.loops), dtype=int32)
+        mesh.loops.foreach_get('vertex_index', loops)
+        materials = empty(len(mesh.polygons), dtype=int32)
+        mesh.polygons.foreach_get('material_index', materials)
+    finally:
+        evaluated.to_mesh_clear()
+    for array in (coords, loops, materials):
+        hasher.update(array.tobytes())
+    for slot in obj.material_slots:
+        material = slot.material
+        if material is not None:
+            hasher.update(repr((material.name_full, settings(material),
+                                node_tree_values(material.node_tree))).encode('utf-8'))
+
+
+def renders(obj, view_layer):
+    """
+    Whether obj shows up in renders of view_layer: it is in a collection the
+    view layer includes and neither it nor its collections are hidden from
+    renders. Hiding it in the viewport doesn't matter.
+    """
+    return (obj.name in view_layer.objects and not obj.hide_render
+            and not any(collection.hide_render for collection in obj.users_collection))
+
+
+def scene_digest(scene, subject, extra=()):
+    """
+    A hash of everything besides the pose that decides how subject renders:
+    render, colour and engine settings with the view curves, the compositor,
+    the camera, the world, lights and the geometry and materials of every
+    mesh that renders. The model's meshes are taken relative to subject, so
+    the hash doesn't change as it turns.
+    extra holds any other values the frames depend on.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr((CACHE_VERSION, plain(extra), bpy.app.version)).encode('utf-8'))
+    owners = [scene.render, scene.render.image_settings, scene.view_settings,
+              scene.display_settings, scene.display, scene.display.shading, scene.eevee,
+              getattr(scene, 'cycles', None), scene.camera.data]
+    for owner in owners:
+        if owner is not None:
+            hasher.update(repr(settings(owner)).encode('utf-8'))
+    hasher.update(repr(curve_values(scene.view_settings.curve_mapping)).encode('utf-8'))
+    # Frames rendered to disk go through the compositor
+    hasher.update(repr((scene.use_nodes, node_tree_values(scene.node_tree) if scene.use_nodes
+                        else None)).encode('utf-8'))
+    hasher.update(repr(plain(scene.camera.matrix_world)).encode('utf-8'))
+    if scene.world is not None:
+        hasher.update(repr((settings(scene.world),
+                            node_tree_values(scene.world.node_tree))).encode('utf-8'))
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    view_layer = bpy.context.view_layer
+    to_subject = subject.matrix_world.inverted()
+    for obj in sorted(scene.objects, key=lambda obj: obj.name_full):
+        if obj.type not in {'MESH', 'LIGHT'} or not renders(obj, view_layer):
+            continue
+        matrix = obj.matrix_world
+        if obj.parent == subject:
+            matrix = to_subject @ matrix
+        hasher.update(repr((obj.name_full, obj.type, plain(matrix))).encode('utf-8'))
+        if obj.type == 'LIGHT':
+            hasher.update(repr(settings(obj.data)).encode('utf-8'))
+        else:
+            mesh_digest(hasher, obj, depsgraph)
+    return hasher.hexdigest()
+
+
+def frame_key(scene_key, subject):
+    """
+    The cache key of the frame of subject in its current pose.
+    """
+    return hashlib.sha256(repr((scene_key, plain(subject.matrix_world))).encode('utf-8')).hexdigest()
@@ -1,11 +1,17 @@
-import re
 import bpy
 from bpy_extras.io_utils import ImportHelper
+from bpy_extras.object_utils import world_to_camera_view
 from bpy.props import StringProperty, BoolProperty
+from contextlib import closing
 from math import radians
-from mathutils import Vector
+from mathutils import Matrix, Vector
 import os
-from . ImageProcessor import ImageProcessor
+import subprocess
+import time
+from . profiling import Profiler, startup
+
+# Modules needing numpy or Pillow are imported by the operators that use them,
+# so loading the add-on when Blender starts doesn't load them too
 
 
 class RotateAndScale(bpy.types.Operator):
@@ -38,34 +44,16 @@ class PositionModel(bpy.types.Operator):
     def execute(self, context):
         # Report "Hello World" to the Info Area
         # self.report({'INFO'}, "Centred")
+        from . splt_bounds import model_bounds
+
         obj = context.window_manager.objectselection_props
-        xs = []
-        ys = []
-        zs = []
-        for child in obj.children:
-            box = child.bound_box
-            print(child.name)
-            world_bound = []
-            for coord in box:
-                world_bound.append(child.matrix_world @ Vector(coord))
-            print(world_bound)
-
-            xs += [i[0] for i in world_bound]
-            ys += [i[1] for i in world_bound]
-            zs += [i[2] for i in world_bound]
-        if not xs:
+        bounds = model_bounds(obj)
+        if bounds is None:
             self.report({'WARNING'}, "Could not find children")
             return {'CANCELLED'}
+        print(bounds)
 
-        deltax = max(xs) - min(xs)
-        deltay = max(ys) - min(ys)
-        deltaz = max(zs) - min(zs)
-
-        x_pos = min(xs) + deltax/2
-        y_pos = min(ys) + deltay/2
-        z_pos = min(zs) + deltaz/2
-
-        bpy.context.scene.cursor.location = [x_pos, y_pos, z_pos]
+        bpy.context.scene.cursor.location = (bounds[0] + bounds[1]) / 2
 
         # obj.location = [x_pos, y_pos, z_pos]
         return {'FINISHED'}
@@ -78,6 +66,8 @@ class PositionCamera(bpy.types.Operator):
     bl_label = "Position Camera"
 
     def execute(self, context):
+        from . splt_bounds import camera_fit
+
         # Report "Hello World" to the Info Area
         self.report({'INFO'}, "Moving camera")
         context.scene.render.resolution_x = context.window_manager.x_resolution
@@ -85,30 +75,22 @@ class PositionCamera(bpy.types.Operator):
 
         obj = context.window_manager.objectselection_props
 
-        bpy.context.scene.camera.rotation_euler = [radians(90), 0, 0]
-
-        bpy.ops.object.select_all(action='DESELECT')
+        camera = bpy.context.scene.camera
+        camera.rotation_euler = [radians(90), 0, 0]
 
-        for child in obj.children:
-            child.select_set(True)
-
-        if not bpy.context.selected_objects:
+        # Fit the whole turntable, including the tilted frames, around the cursor
+        fit = camera_fit(obj, context.scene, bpy.context.scene.cursor.location)
+        if fit is None:
             self.report({'WARNING'}, "Could not find children")
             return {'CANCELLED'}
+        location, ortho_scale, clip_end = fit
+        camera.location = location
+        if ortho_scale is not None:
+            camera.data.ortho_scale = ortho_scale
+        camera.data.clip_end = max(camera.data.clip_end, clip_end)
 
-        # print(largest.name)
-        context.region_data.view_perspective = 'CAMERA'
-        bpy.context.view_layer.objects.active = obj
-
-        bpy.context.scene.camera.select_set(True)
-        bpy.ops.view3d.camera_to_view_selected()
-
-        bpy.ops.object.select_all(action='DESELECT')
-        bpy.context.scene.camera.select_set(True)
-        bpy.context.view_layer.objects.active = bpy.context.scene.camera
-
-        bpy.ops.transform.translate(
-            value=(0.0, 0.0, 10.0), orient_type='LOCAL')
+        if context.region_data:
+            context.region_data.view_perspective = 'CAMERA'
 
         return {'FINISHED'}
 
@@ -120,38 +102,18 @@ class CheckRotateModel(bpy.types.Operator):
 
     limits: bpy.props.IntProperty(default=0)  # not 'limits ='
     _timer = None
-    original_rotation = [0, 0, 0]
+    original_matrix = None
+    poses = []
 
     def modal(self, context, event):
-        x_rot = context.window_manager.x_rotations
-        y_rot = context.window_manager.y_rotations
-        total_steps = x_rot * (2*y_rot + 2)
-        if event.type in {'RIGHTMOUSE', 'ESC'} or self.limits > total_steps:
+        if event.type in {'RIGHTMOUSE', 'ESC'} or self.limits >= len(self.poses):
             self.limits = 0
             self.cancel(context)
             return {'FINISHED'}
 
         if event.type == 'TIMER':
             subject = context.window_manager.objectselection_props
-            bpy.ops.object.select_all(action='DESELECT')
-            subject.select_set(True)
-            bpy.context.view_layer.objects.active = subject
-
-            rotation_steps = context.window_manager.x_rotations
-
-            rotation_angle = 360
-
-            centre = bpy.context.scene.cursor.location
-            rot = [15, -15, -15, 15]
-            y_rotation = rot[self.limits % 4]
-
-            if not (self.limits % 4):
-                bpy.ops.transform.rotate(
-                    value=-1 * radians(rotation_angle/rotation_steps), center_override=centre, orient_type='GLOBAL')
-
-            bpy.ops.transform.rotate(value=radians(
-                y_rotation), orient_axis='Y', orient_type='LOCAL', center_override=centre)
-
+            subject.matrix_world = self.poses[self.limits][1]
             self.limits += 1
         return {'PASS_THROUGH'}
 
@@ -160,19 +122,17 @@ class CheckRotateModel(bpy.types.Operator):
         wm = context.window_manager
         self._timer = wm.event_timer_add(time_step=0.1, window=context.window)
         obj = context.window_manager.objectselection_props
-        if self.limits == 0:
-            self.original_rotation = obj.rotation_euler.copy()
-            self.original_location = obj.location.copy()
-        print(self.original_rotation)
+        self.original_matrix = obj.matrix_world.copy()
+        self.poses = pose_table(self.original_matrix, bpy.context.scene.cursor.location,
+                                wm.x_rotations)
+        print(self.original_matrix)
         wm.modal_handler_add(self)
         return {'RUNNING_MODAL'}
 
     def cancel(self, context):
         obj = context.window_manager.objectselection_props
         wm = context.window_manager
-        print(self.original_rotation)
-        obj.rotation_euler = self.original_rotation.copy()
-        obj.location = self.original_location.copy()
+        obj.matrix_world = self.original_matrix
         wm.event_timer_remove(self._timer)
 
 
@@ -242,6 +202,237 @@ class AddHRDI(bpy.types.Operator):
         return {"FINISHED"}
 
 
+def viewer_matches_render(scene):
+    """
+    Whether the Viewer node's pixels, encoded with the plain sRGB curve
+    ImageProcessor.add_frame uses, come out the same as a saved render: the
+    Standard view transform on an sRGB display with no look, exposure, gamma
+    or curves, and no compositing besides the render layers themselves.
+    """
+    view = scene.view_settings
+    if (scene.display_settings.display_device != 'sRGB' or view.view_transform != 'Standard'
+            or view.look != 'None' or view.exposure != 0 or view.gamma != 1
+            or view.use_curve_mapping):
+        return False
+    return not scene.use_nodes or scene.node_tree is None or all(
+        node.type in {'R_LAYERS', 'COMPOSITE', 'VIEWER'} for node in scene.node_tree.nodes)
+
+
+def use_viewer_node(scene):
+    """
+    Links the render layers to a compositor Viewer node, so each render's pixels
+    can be read back from the Viewer Node image without saving a file.
+    Returns what restore_compositor needs to put the compositor back.
+    """
+    state = {'use_nodes': scene.use_nodes, 'added': []}
+    scene.use_nodes = True
+    nodes = scene.node_tree.nodes
+    layers = next((n for n in nodes if n.type == 'R_LAYERS'), None)
+    if layers is None:
+        layers = nodes.new('CompositorNodeRLayers')
+        state['added'].append(layers.name)
+    viewer = next((n for n in nodes if n.type == 'VIEWER'), None)
+    if viewer is None:
+        viewer = nodes.new('CompositorNodeViewer')
+        state['added'].append(viewer.name)
+    else:
+        state['viewer'] = viewer.name
+        state['use_alpha'] = viewer.use_alpha
+        state['links'] = [(link.from_node.name, link.from_socket.name)
+                          for link in viewer.inputs['Image'].links]
+    viewer.use_alpha = True
+    scene.node_tree.links.new(layers.outputs['Image'], viewer.inputs['Image'])
+    return state
+
+
+def restore_compositor(scene, state):
+    """
+    Removes the nodes use_viewer_node added and relinks a Viewer node that
+    was already there as it was.
+    """
+    tree = scene.node_tree
+    for name in state['added']:
+        tree.nodes.remove(tree.nodes[name])
+    if 'viewer' in state:
+        viewer = tree.nodes[state['viewer']]
+        for link in list(viewer.inputs['Image'].links):
+            tree.links.remove(link)
+        for node, socket in state['links']:
+            tree.links.new(tree.nodes[node].outputs[socket], viewer.inputs['Image'])
+        viewer.use_alpha = state['use_alpha']
+    scene.use_nodes = state['use_nodes']
+
+
+def render_pixels():
+    """
+    Renders the scene and returns its pixels as a (height, width, 4) float
+    array, top row first. The Viewer node holds linear, premultiplied colour
+    without the view transform, see ImageProcessor.add_frame.
+    """
+    from numpy import empty, float32
+
+    bpy.ops.render.render()
+    image = bpy.data.images['Viewer Node']
+    width, height = image.size
+    pixels = empty(width * height * 4, dtype=float32)
+    image.pixels.foreach_get(pixels)
+    # Blender stores the bottom row first
+    return pixels.reshape(height, width, 4)[::-1]
+
+
+def saved_settings(owner, names):
+    """
+    The current values of the named properties of owner, for restore_settings.
+    """
+    return {name: getattr(owner, name) for name in names}
+
+
+def restore_settings(owner, settings):
+    for name, value in settings.items():
+        setattr(owner, name, value)
+
+
+# Degrees each step's frames are tilted by about the model's own Y axis, in order
+TILTS = (-15, 0, 15)
+
+
+def pose_table(matrix, centre, rotation_steps, tilts=TILTS):
+    """
+    ((step, tilt), world matrix) for every pose of the turntable in render order,
+    for a model with the given world matrix turning about centre. Step s turns
+    (s + 1) / rotation_steps of a circle about the global Z axis, then the tilt
+    rotates about the model's Y axis. These are the poses the chain of
+    transform.rotate calls used to reach, which turn the opposite way to their
+    value: -1 step about Z, then tilts of +15, -15 and -15 and a +15 back.
+    """
+    # TODO customise rotation angle, vertical steps
+    rotation_angle = 360
+    centre = Vector(centre)
+    to_centre = Matrix.Translation(centre)
+    from_centre = Matrix.Translation(-centre) @ matrix
+    axis = matrix.to_3x3().col[1].normalized()
+    poses = []
+    for step in range(0, rotation_steps):
+        turn = to_centre @ Matrix.Rotation(
+            radians(rotation_angle * (step + 1) / rotation_steps), 4, 'Z')
+        for i, tilt in enumerate(tilts):
+            poses.append(((step, i), turn @ Matrix.Rotation(radians(tilt), 4, axis) @ from_centre))
+    return poses
+
+
+def turntable_poses(subject, rotation_steps, centre):
+    """
+    Sets subject to every pose of pose_table in turn, yielding (step, tilt)
+    once each is set, and puts it back as it was afterwards.
+    """
+    original = subject.matrix_world.copy()
+    try:
+        for key, matrix in pose_table(original, centre, rotation_steps):
+            subject.matrix_world = matrix
+            yield key
+    finally:
+        subject.matrix_world = original
+
+
+# Image settings RenderWiki sets for the frames it writes and puts back afterwards
+FRAME_FORMAT_SETTINGS = ('file_format', 'color_mode')
+BORDER_SETTINGS = ('use_border', 'use_crop_to_border', 'border_min_x',
+                   'border_min_y', 'border_max_x', 'border_max_y')
+
+
+def model_corners(obj):
+    """
+    World-space corners of the bounding boxes of the model's child meshes.
+    """
+    return [child.matrix_world @ Vector(corner)
+            for child in obj.children if child.type == 'MESH'
+            for corner in child.bound_box]
+
+
+def set_render_border(scene, corners, margin):
+    """
+    Limits rendering to the rectangle the corners project to in the camera, plus
+    margin pixels. The border is not cropped to, so frames keep their full size
+    and the offsets ImageProcessor reports do not change. Renders the whole
+    frame if there is nothing to bound or part of it is behind the camera.
+    """
+    render = scene.render
+    points = [world_to_camera_view(scene, scene.camera, corner) for corner in corners]
+    if not points or any(point.z <= 0 for point in points):
+        render.use_border = False
+        return
+    scale = render.resolution_percentage / 100
+    margin_x = margin / (render.resolution_x * scale)
+    margin_y = margin / (render.resolution_y * scale)
+    render.border_min_x = max(0.0, min(point.x for point in points) - margin_x)
+    render.border_max_x = min(1.0, max(point.x for point in points) + margin_x)
+    render.border_min_y = max(0.0, min(point.y for point in points) - margin_y)
+    render.border_max_y = min(1.0, max(point.y for point in points) + margin_y)
+    render.use_crop_to_border = False
+    render.use_border = True
+
+
+# Seconds render_distributed waits on the workers between reports
+WORKER_POLL = 0.1
+
+def render_distributed(scene, subject, rotation_steps, directory, workers, border_margin=None,
+                       poses=None):
+    """
+    Saves the prepared scene and renders its poses on workers background Blender
+    processes at once, see splt_worker.py, into directory as
+    render<step><tilt>.png. poses is a list of the indices in pose_table to
+    render, or None for all of them. The CPU threads are split between the
+    workers. While they run this yields the number of frames written so far
+    about every WORKER_POLL seconds, and closing it early stops them.
+    Raises RuntimeError if any of them fails.
+    """
+    scene_file = os.path.join(directory, 'scene.blend')
+    bpy.ops.wm.save_as_mainfile(filepath=scene_file, copy=True)
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'splt_worker.py')
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    processes = []
+    try:
+        for worker in range(workers):
+            command = [bpy.app.binary_path, '-b', scene_file, '-t', str(threads),
+                       '--python', script, '--',
+                       '--subject', subject.name, '--steps', str(rotation_steps),
+                       '--worker', str(worker), '--workers', str(workers),
+                       '--output', directory]
+            if border_margin is not None:
+                command += ['--border-margin', str(border_margin)]
+            if poses is not None:
+                command += ['--poses', ','.join(str(pose) for pose in poses)]
+            processes.append(subprocess.Popen(command))
+        running = processes
+        while running:
+            try:
+                running[0].wait(WORKER_POLL)
+            except subprocess.TimeoutExpired:
+                pass
+            running = [process for process in processes if process.poll() is None]
+            yield len([f for f in os.listdir(directory)
+                       if f.startswith('render') and f.endswith('.png')])
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        os.remove(scene_file)
+    failed = [worker for worker, process in enumerate(processes) if process.returncode]
+    if failed:
+        raise RuntimeError('Render workers %s failed' % ', '.join(str(w) for w in failed))
+
+
+# Seconds between the ticks of a running render job, see RenderWiki.modal
+JOB_TICK = 0.01
+# Frames the time left is estimated from
+ETA_FRAMES = 10
+
+
+def format_seconds(seconds):
+    return '%d:%02d' % divmod(int(seconds), 60)
+
+
 class RenderWiki(bpy.types.Operator):
 
     """Render weapon to a format accepted by the Wiki"""
@@ -249,61 +440,332 @@ class RenderWiki(bpy.types.Operator):
     bl_label = "Render to Wiki Image"
     bl_options = {'REGISTER'}
 
+    _timer = None
+    job = None
+    running = False
+
+    @classmethod
+    def poll(cls, context):
+        # One job at a time, they share the scene and the model's transform
+        return not cls.running
+
     def execute(self, context):
+        # Scripts run the whole job at once
+        job = self.render_job(context)
+        try:
+            while True:
+                next(job)
+        except StopIteration as stop:
+            return stop.value
+
+    def invoke(self, context, event):
+        self.job = self.render_job(context)
+        # Runs up to the first pose, so bad settings are reported right away
+        try:
+            done, total, message = next(self.job)
+        except StopIteration as stop:
+            return stop.value
+        RenderWiki.running = True
+        wm = context.window_manager
+        wm.progress_begin(0, total)
+        self.done = done
+        self.frame_times = []
+        self.last_tick = time.perf_counter()
+        self._timer = wm.event_timer_add(time_step=JOB_TICK, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
 
-        context.scene.render.resolution_x = context.window_manager.x_resolution
-        context.scene.render.resolution_y = context.window_manager.y_resolution
-        directory = context.window_manager.output_folder
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel(context)
+            self.report({'WARNING'}, 'Render cancelled')
+            return {'CANCELLED'}
+
+        if event.type == 'TIMER':
+            try:
+                done, total, message = next(self.job)
+            except StopIteration as stop:
+                self.finish(context)
+                return stop.value
+            except Exception:
+                self.finish(context)
+                raise
+            self.show_progress(context, done, total, message)
+        return {'PASS_THROUGH'}
+
+    def show_progress(self, context, done, total, message):
+        """
+        Shows how many frames are done and the time left, estimated from how
+        long the last ETA_FRAMES frames took, in the status bar.
+        """
+        now = time.perf_counter()
+        if done > self.done:
+            self.frame_times.append((now - self.last_tick) / (done - self.done))
+            self.frame_times = self.frame_times[-ETA_FRAMES:]
+        self.done = done
+        self.last_tick = now
+        context.window_manager.progress_update(done)
+        text = '%s: %d of %d frames' % (message, done, total)
+        if self.frame_times and done < total:
+            left = sum(self.frame_times) / len(self.frame_times) * (total - done)
+            text += ', about %s left' % format_seconds(left)
+        context.workspace.status_text_set(text + ' (Esc to cancel)')
+
+    def cancel(self, context):
+        # Also called by Blender when it ends the job itself, such as when a
+        # file is loaded. Closing the job puts the model and settings back
+        self.job.close()
+        self.finish(context)
+
+    def finish(self, context):
+        RenderWiki.running = False
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        if context.workspace is not None:
+            context.workspace.status_text_set(None)
+
+    def render_job(self, context):
+        """
+        The render as a generator, one pose per step, yielding (frames done,
+        total frames, what it is doing) after each. The scene and windows
+        are only taken from context before the first yield, as later steps
+        run from timer events. Returns the operator's result. Closing it
+        early puts the model's transform and the render border back and
+        keeps the frames already rendered in the cache.
+        """
+        from . ImageProcessor import ImageProcessor, FRAME_ARCHIVE, measure_frame
+        from . frame_cache import FrameCache
+        from . splt_cache import frame_key, scene_digest
+
+        scene = context.scene
+        wm = context.window_manager
+        view_layer = context.view_layer
+        scene.render.resolution_x = wm.x_resolution
+        scene.render.resolution_y = wm.y_resolution
+        directory = wm.output_folder
         if not directory:
             self.report({'ERROR_INVALID_INPUT'},
                         'Please select an output folder')
             return {'CANCELLED'}
         directory = bpy.path.abspath(directory)
+        try:
+            dimensions = [int(size) for size in wm.extra_dimensions.replace(',', ' ').split()]
+        except ValueError:
+            self.report({'ERROR_INVALID_INPUT'},
+                        'Extra sizes must be whole numbers separated by commas')
+            return {'CANCELLED'}
+        subject = wm.objectselection_props
+        bpy.ops.object.select_all(action='DESELECT')
+        subject.select_set(True)
+        view_layer.objects.active = subject
+
+        rotation_steps = wm.x_rotations
+        total = rotation_steps * len(TILTS)
+        profiler = Profiler()
+        # Tracks what loading the add-on cost alongside the render it served
+        profiler.info['startup'] = startup.seconds()
+        memory_budget = wm.memory_budget * 1024 * 1024
+        p = ImageProcessor(rotation_steps, 1, memory_budget or None, profiler)
+        # Split the poses between background Blender processes
+        workers = wm.render_workers
+        distributed = workers > 1
+        # Frames are only written to disk and read back when debugging, or
+        # when the view transform or compositor would give the Viewer node
+        # different colours from a saved render
+        write_frames = wm.debug_write_frames
+        if not write_frames and not distributed and not viewer_matches_render(scene):
+            print("Colour management or compositing is in use, writing frames to disk")
+            write_frames = True
+        # Blend each frame in the background while the next one renders
+        pipelined = wm.pipelined_blend and not distributed
+        centre = scene.cursor.location.copy()
+        output_file_pattern_string = 'render%d%d.png'
+        # Only shade the part of each frame the model can cover
+        use_border = wm.use_render_border
+        border_margin = wm.render_border_margin
+        render = scene.render
+        saved_border = saved_settings(render, BORDER_SETTINGS)
+        saved_format = saved_settings(render.image_settings, FRAME_FORMAT_SETTINGS)
+        compositor = None
+        poses = None
+        # Everything changed from here on is put back by the finally below,
+        # however the job ends
+        try:
+            if pipelined:
+                p.start_pipeline()
+            if write_frames or distributed:
+                if not os.path.exists(os.path.join(directory, "tmp")):
+                    os.mkdir(os.path.join(directory, "tmp"))
+                for f in os.listdir(os.path.join(directory, "tmp")):
+                    os.remove(os.path.join(os.path.join(directory, "tmp"), f))
+            else:
+                compositor = use_viewer_node(scene)
+            # Frames written to disk are PNG to keep their transparency, as in
+            # splt_worker.py, and so the name they are read back by is right
+            if write_frames:
+                render.image_settings.file_format = 'PNG'
+                render.image_settings.color_mode = 'RGBA'
+            # Frames whose scene and pose hash to a stored frame aren't rendered again
+            if wm.use_render_cache:
+                p.cache = FrameCache(os.path.join(directory, 'cache'))
+                # Worker and disk frames are saved renders, with the view transform,
+                # while Viewer node frames are encoded here, so they don't mix
+                source = 'workers' if distributed else 'disk' if write_frames else 'viewer'
+                with profiler.stage('cache'):
+                    scene_key = scene_digest(scene, subject, (use_border, border_margin, source))
+            # Frames written to disk to blend afterwards, as (file, (step, tilt))
+            rendered = []
+            # Indices in the pose table of the frames the workers have to render
+            missing = []
+            cached = 0
+            yield 0, total, 'Rendering'
+
+            poses = turntable_poses(subject, rotation_steps, centre)
+            for index, (step, i) in enumerate(poses):
+                if p.cache is not None and p.add_from_cache(step, i, frame_key(scene_key, subject)):
+                    cached += 1
+                elif distributed:
+                    missing.append(index)
+                    rendered.append((os.path.join(directory, 'tmp', 'render%d%d.png' % (step, i)),
+                                     (step, i)))
+                else:
+                    if use_border:
+                        with profiler.stage('border'):
+                            view_layer.update()
+                            set_render_border(scene, model_corners(subject), border_margin)
+                    if write_frames:
+                        render.filepath = os.path.join(
+                            os.path.join(directory, "tmp"), (output_file_pattern_string % (step, i)))
+                        with profiler.stage('render'):
+                            bpy.ops.render.render(write_still=True)
+                        if pipelined:
+                            p.submit_file(render.filepath, step, i)
+                        else:
+                            rendered.append((render.filepath, (step, i)))
+                    else:
+                        with profiler.stage('render'):
+                            pixels = render_pixels()
+                        if pipelined:
+                            p.submit_frame(pixels, step, i, linear=True, premultiplied=True)
+                        else:
+                            p.add_frame(pixels, step, i, linear=True, premultiplied=True)
+                # Poses left for the workers aren't done yet
+                yield index + 1 - len(missing), total, 'Rendering'
+            print('Frames from cache: %d' % cached)
+            if missing:
+                try:
+                    with profiler.stage('render'), closing(render_distributed(
+                            scene, subject, rotation_steps, os.path.join(directory, 'tmp'),
+                            workers, border_margin if use_border else None, missing)) as progress:
+                        for done in progress:
+                            # Blended and cached as soon as a worker writes
+                            # them, so a stopped job resumes from them
+                            finished = [frame for frame in rendered if os.path.exists(frame[0])]
+                            for file, (step, i) in finished:
+                                p.add_placed(step, i, *measure_frame(file))
+                            rendered = [frame for frame in rendered if frame not in finished]
+                            yield cached + done, total, 'Rendering on %d workers' % workers
+                except (OSError, RuntimeError) as err:
+                    self.report({'ERROR'}, str(err))
+                    return {'CANCELLED'}
+        finally:
+            if poses is not None:
+                poses.close()
+            restore_settings(render, saved_border)
+            restore_settings(render.image_settings, saved_format)
+            if compositor is not None:
+                restore_compositor(scene, compositor)
+            # Even when cancelled, so frames still blending reach the cache
+            p.finish_pipeline()
+
+        yield total, total, 'Rendering final.png'
+        render.filepath = os.path.join(
+            os.path.join(directory), "final.png")
+        with profiler.stage('render'):
+            bpy.ops.render.render(write_still=True)
+        if rendered:
+            yield total, total, 'Blending'
+            p.blend_many([file for file, _ in rendered], keys=[key for _, key in rendered])
+        if wm.save_frame_archive:
+            # Lets the CLI stitch again at other sizes without rendering
+            p.save_archive(os.path.join(directory, FRAME_ARCHIVE))
+
+        yield total, total, 'Stitching'
+        file_format = str(wm.output_format)
+        layout = str(wm.output_layout)
+        deduplicate = None
+        if wm.deduplicate_frames:
+            deduplicate = wm.dedup_tolerance
+        p.stitch_and_upload(directory, file_format, layout,
+                            streaming=wm.stream_output,
+                            deduplicate=deduplicate,
+                            compare_formats=wm.compare_formats,
+                            dimensions=dimensions)
+        return {'FINISHED'}
+
+
+# Render settings the preview changes and puts back afterwards
+PREVIEW_SETTINGS = ('engine', 'resolution_x', 'resolution_y',
+                    'resolution_percentage', 'use_border')
+PREVIEW_DIMENSION = 96
+
+
+class PreviewTurntable(bpy.types.Operator):
+
+    """Render every pose small and fast into a contact sheet to check orientation and framing"""
+    bl_idname = "object.preview_turntable"
+    bl_label = "Preview Turntable"
+
+    def execute(self, context):
+        from . ImageProcessor import ImageProcessor
+
+        directory = context.window_manager.output_folder
+        if not directory:
+            self.report({'ERROR_INVALID_INPUT'},
+                        'Please select an output folder')
+            return {'CANCELLED'}
+        # Kept apart from the real sheet and offsets
+        directory = os.path.join(bpy.path.abspath(directory), 'preview')
+        if not os.path.exists(directory):
+            os.mkdir(directory)
         subject = context.window_manager.objectselection_props
         bpy.ops.object.select_all(action='DESELECT')
         subject.select_set(True)
         bpy.context.view_layer.objects.active = subject
 
-        rotation_steps = context.window_manager.x_rotations
+        scene = context.scene
+        render = scene.render
+        saved_render = saved_settings(render, PREVIEW_SETTINGS)
+        saved_display = saved_settings(scene.display, ('render_aa',))
 
-        # TODO customise rotation angle, vertical steps
-        rotation_angle = 360
-
-        original_rotation = subject.rotation_euler
-        centre = bpy.context.scene.cursor.location
-        output_file_pattern_string = 'render%d%d.jpg'
-        if not os.path.exists(os.path.join(directory, "tmp")):
-            os.mkdir(os.path.join(directory, "tmp"))
-        for f in os.listdir(os.path.join(directory, "tmp")):
-            os.remove(os.path.join(os.path.join(directory, "tmp"), f))
-        for step in range(0, rotation_steps):
-
-            bpy.ops.transform.rotate(
-                value=-1 * radians(rotation_angle/rotation_steps), center_override=centre, orient_type='GLOBAL')
-            rot = [15, -15, -15]
-            for i in range(3):
-                bpy.ops.transform.rotate(value=radians(
-                    rot[i]), orient_axis='Y', orient_type='LOCAL', center_override=centre)
-
-                bpy.context.scene.render.filepath = os.path.join(
-                    os.path.join(directory, "tmp"), (output_file_pattern_string % (step, i)))
-                bpy.ops.render.render(write_still=True)
-            bpy.ops.transform.rotate(
-                value=radians(15), orient_axis='Y', orient_type='LOCAL', center_override=centre)
-        subject.rotation_euler = original_rotation
-        bpy.context.scene.render.filepath = os.path.join(
-            os.path.join(directory), "final.png")
-        bpy.ops.render.render(write_still=True)
-        files = os.listdir(os.path.join(directory, 'tmp'))
-        files.sort(key=lambda f: int(re.sub('\D', '', f)))
+        # Workbench at a fraction of the resolution takes milliseconds a pose
+        render.engine = 'BLENDER_WORKBENCH'
+        render.resolution_x = context.window_manager.x_resolution
+        render.resolution_y = context.window_manager.y_resolution
+        render.resolution_percentage = context.window_manager.preview_scale
+        render.use_border = False
+        scene.display.render_aa = 'FXAA'
+        compositor = use_viewer_node(scene)
 
+        rotation_steps = context.window_manager.x_rotations
         p = ImageProcessor(rotation_steps, 1)
-        for i, filename in enumerate(files):
-            print(filename)
-            p.blend(os.path.join(directory, 'tmp', filename))
-
-        file_format = str(context.window_manager.output_format)
-        p.stitch_and_upload(directory, file_format)
+        p.target_dimension = PREVIEW_DIMENSION
+        p.target_size = None
+        start = time.perf_counter()
+        try:
+            for step, i in turntable_poses(subject, rotation_steps, scene.cursor.location):
+                p.add_frame(render_pixels(), step, i, linear=True, premultiplied=True)
+        finally:
+            restore_settings(render, saved_render)
+            restore_settings(scene.display, saved_display)
+            restore_compositor(scene, compositor)
+        p.stitch_and_upload(directory, "PNG", "ATLAS")
+
+        sheet = bpy.data.images.load(os.path.join(directory, 'weapon.png'), check_existing=True)
+        sheet.reload()
+        self.report({'INFO'}, "Previewed %d poses in %.1fs, see %s" % (
+            len(p.images), time.perf_counter() - start, sheet.name))
         return {'FINISHED'}
 
 
@@ -19,6 +19,9 @@ class SPLT_PT_Panel(bpy.types.Panel):
         box.operator("object.position_model")
         box.operator("object.position_camera")
         box.operator("object.check_rotation")
+        row = box.row()
+        row.operator("object.preview_turntable")
+        row.prop(context.window_manager, "preview_scale")
         box.operator("object.fix_material")
         box.operator("object.addhdri")
 
@@ -32,11 +35,30 @@ class SPLT_PT_Panel(bpy.types.Panel):
         row = box.row()
         row.prop(context.window_manager, "x_resolution")
         row.prop(context.window_manager, "y_resolution")
-        box.prop(context.window_manager, "output_format")
+        row = box.row()
+        row.prop(context.window_manager, "output_format")
+        row.prop(context.window_manager, "compare_formats")
+        box.prop(context.window_manager, "output_layout")
+        box.prop(context.window_manager, "extra_dimensions")
+        box.prop(context.window_manager, "memory_budget")
+        box.prop(context.window_manager, "stream_output")
+        row = box.row()
+        # Strip offsets imply each frame's width, so only atlases share slots
+        row.enabled = context.window_manager.output_layout == "ATLAS"
+        row.prop(context.window_manager, "deduplicate_frames")
+        row.prop(context.window_manager, "dedup_tolerance")
+        row = box.row()
+        row.prop(context.window_manager, "use_render_border")
+        row.prop(context.window_manager, "render_border_margin")
 
         layout.separator()
         box = layout.box()
         box.prop(context.window_manager, "output_folder")
+        box.prop(context.window_manager, "render_workers")
+        box.prop(context.window_manager, "use_render_cache")
+        box.prop(context.window_manager, "pipelined_blend")
+        box.prop(context.window_manager, "save_frame_archive")
+        box.prop(context.window_manager, "debug_write_frames")
         box.operator("object.render_wiki")
         layout.separator()
 
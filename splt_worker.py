@@ -0,0 +1,64 @@
+"""
+Renders a slice of a weapon's turntable poses in a background Blender.
+RenderWiki starts these when rendering with several workers:
+
+    blender -b scene.blend --python splt_worker.py -- --subject NAME --steps 36 --worker 0 --workers 4 --output DIR
+
+Poses are set straight from the pose table. The poses to render, all of them
+unless --poses lists some, are dealt out between the workers in turn and each
+is written as render<step><tilt>.png.
+"""
+import argparse
+import importlib
+import os
+import sys
+import bpy
+
+# Import the add-on from the folder this script is in, whatever it is installed as
+addon = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(addon))
+splt_ops = importlib.import_module(os.path.basename(addon) + '.splt_ops')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--subject', required=True, help='name of the model to rotate')
+    parser.add_argument('--steps', type=int, required=True, help='rotation steps in the turntable')
+    parser.add_argument('--worker', type=int, required=True)
+    parser.add_argument('--workers', type=int, required=True)
+    parser.add_argument('--output', required=True, help='folder to write frames to')
+    parser.add_argument('--border-margin', type=int, default=None,
+                        help='render only the projected model bounds plus this many pixels')
+    parser.add_argument('--poses', default=None,
+                        help='comma-separated indices in the pose table to render, default all')
+    args = parser.parse_args(argv)
+
+    scene = bpy.context.scene
+    subject = bpy.data.objects[args.subject]
+    # PNG keeps the transparency the frames are cropped by
+    scene.render.image_settings.file_format = 'PNG'
+    scene.render.image_settings.color_mode = 'RGBA'
+
+    if args.poses:
+        wanted = [int(pose) for pose in args.poses.split(',')]
+    else:
+        wanted = range(args.steps * len(splt_ops.TILTS))
+    mine = set(wanted[args.worker::args.workers])
+
+    poses = splt_ops.turntable_poses(subject, args.steps, scene.cursor.location)
+    for index, (step, i) in enumerate(poses):
+        if index not in mine:
+            continue
+        if args.border_margin is not None:
+            bpy.context.view_layer.update()
+            splt_ops.set_render_border(
+                scene, splt_ops.model_corners(subject), args.border_margin)
+        # Written under another name first, so a frame is only ever seen whole
+        frame = os.path.join(args.output, 'render%d%d.png' % (step, i))
+        scene.render.filepath = os.path.join(args.output, 'partial%d%d.png' % (step, i))
+        bpy.ops.render.render(write_still=True)
+        os.replace(scene.render.filepath, frame)
+        print('Worker %d rendered %s' % (args.worker, frame))
+
+
+main(sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else [])